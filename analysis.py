@@ -0,0 +1,307 @@
+"""
+Bulk analysis of positions: cubeless equity of every position and the
+best move for its roll.
+
+Positions are read from a text file of position IDs, one per line as
+
+    <position id> [o|x] [roll, e.g. 31]
+
+where the player is the one on roll (players[0] by default), or from a
+corpus directory (see corpus). Positions are processed in batches: the
+moves of a batch are generated on a process pool, while the network
+evaluates the previous batch, the positions and all their afterstates
+in a few large calls. Results are streamed as JSON lines or CSV, one row
+per position and roll.
+
+Position IDs follow GNU Backgammon: for each player, starting with the
+one not on roll, the pieces on the 24 points counted from that player's
+ace point and on the bar are written as that many 1 bits followed by a
+0, and the 80 bits are encoded in base64 without padding.
+"""
+from __future__ import division
+
+import csv
+import json
+import base64
+import itertools
+import collections
+import multiprocessing
+
+import numpy as np
+
+from backgammon.game import Game
+from backgammon.agents.td_gammon_agent import equity
+
+PIECES = 15
+ROLLS = [(a, b) for a in range(1, 7) for b in range(a, 7)]
+FIELDS = ['id', 'player', 'roll', 'equity', 'move', 'move_equity', 'moves']
+
+
+def _relative(board, k):
+    """
+    Counts of player k on its 24 points from its ace point, then the bar.
+    players[0] moves up the grid and bears off past the last point.
+    """
+    points = board[k, Game.NUMCOLS - 1::-1] if k == 0 else board[k, :Game.NUMCOLS]
+    return [int(n) for n in points] + [int(board[k, Game.NUMCOLS])]
+
+
+def position_id(board, turn):
+    """
+    Position ID of a board array (see Game.board_array) with the player
+    of index turn on roll.
+    """
+    bits = []
+    for k in (1 - turn, turn):
+        for n in _relative(board, k):
+            bits += [1] * n + [0]
+    bits += [0] * (80 - len(bits))
+    key = bytes(sum(bit << j for j, bit in enumerate(bits[i:i + 8])) for i in range(0, 80, 8))
+    return base64.b64encode(key).decode('ascii')[:14]
+
+
+def board_from_position_id(pid, turn=0):
+    """
+    Board array of a position ID, the player of index turn on roll.
+    """
+    try:
+        key = base64.b64decode(pid + '==', validate=True)
+    except ValueError:
+        raise ValueError('Invalid position ID %r' % pid)
+    if len(pid) != 14 or len(key) != 10:
+        raise ValueError('Invalid position ID %r' % pid)
+
+    bits = [(byte >> j) & 1 for byte in key for j in range(8)]
+    counts, n = [], 0
+    for bit in bits:
+        if len(counts) == 50:
+            break
+        if bit:
+            n += 1
+        else:
+            counts.append(n)
+            n = 0
+    if len(counts) < 50:
+        raise ValueError('Invalid position ID %r' % pid)
+
+    board = np.zeros((2, Game.NUMCOLS + 2), dtype=np.int8)
+    for k, relative in ((1 - turn, counts[:25]), (turn, counts[25:])):
+        if sum(relative) > PIECES:
+            raise ValueError('Invalid position ID %r: more than %d pieces' % (pid, PIECES))
+        points = relative[:Game.NUMCOLS]
+        board[k, :Game.NUMCOLS] = points[::-1] if k == 0 else points
+        board[k, Game.NUMCOLS] = relative[Game.NUMCOLS]
+        board[k, Game.NUMCOLS + 1] = PIECES - sum(relative)
+    for i in range(Game.NUMCOLS):
+        if board[0, i] and board[1, i]:
+            raise ValueError('Invalid position ID %r: both players on point %d' % (pid, i))
+    return board
+
+
+def parse_roll(text):
+    if len(text) != 2 or not all('1' <= c <= str(Game.QUAD) for c in text):
+        raise ValueError('Invalid roll %r' % text)
+    return int(text[0]), int(text[1])
+
+
+def read_position_ids(path):
+    """
+    (board, turn, roll) of every line of a position ID file, roll is None
+    when the line has none. Empty lines and lines starting with # are
+    skipped.
+    """
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            try:
+                turn, roll = 0, None
+                for field in fields[1:]:
+                    if field in Game.TOKENS:
+                        turn = Game.TOKENS.index(field)
+                    else:
+                        roll = parse_roll(field)
+                yield board_from_position_id(fields[0], turn), turn, roll
+            except ValueError as e:
+                raise ValueError('%s:%d: %s' % (path, number, e))
+
+
+def read_corpus(path, chunk=65536):
+    """
+    (board, turn, None) of every row of a corpus, read in chunks of the
+    memory-mapped columns.
+    """
+    import corpus
+    positions = corpus.Corpus(path)
+    for start in range(0, len(positions), chunk):
+        boards = np.array(positions.boards[start:start + chunk])
+        turns = np.array(positions.turns[start:start + chunk])
+        for board, turn in zip(boards, turns):
+            yield board, int(turn), None
+
+
+def move_text(action):
+    """
+    A move as "start,end" pairs, the format of the sessions protocol.
+    """
+    return ' '.join('%s,%s' % step for step in action) if action else ''
+
+
+def afterstates(board, turn, roll):
+    """
+    Legal moves of the player on roll and the board array reached by each,
+    one move per distinct board. The moves are sorted so the results do
+    not depend on the iteration order of the move set.
+    """
+    game = Game.from_board_array(board)
+    player = game.players[turn]
+    actions = sorted(game.get_actions_doubles(roll, player, nodups=True), key=str)
+    boards = game.afterstate_boards(actions, player)
+
+    # orders of the same steps reach the same board
+    reached = {}
+    for i, after in enumerate(boards):
+        reached.setdefault(after.tobytes(), i)
+    first = list(reached.values())
+    return [actions[i] for i in first], boards[first]
+
+
+def _expand(positions, all_rolls):
+    for board, turn, roll in positions:
+        if roll is None and all_rolls:
+            for r in ROLLS:
+                yield board, turn, r
+        else:
+            yield board, turn, roll
+
+
+def _batches(positions, batch_size):
+    positions = iter(positions)
+    while True:
+        batch = list(itertools.islice(positions, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _generate(batch):
+    """
+    Moves and afterstates of every (position, roll) of a batch, None
+    without a roll. Runs on the pool.
+    """
+    return batch, [None if roll is None else afterstates(board, turn, roll) for board, turn, roll in batch]
+
+
+def _equities(model, encoder, boards, turns, batch_size):
+    """
+    Equity for players[1] of boards with the player of index turns to move.
+    """
+    values = np.empty(len(boards))
+    for start in range(0, len(boards), batch_size):
+        end = start + batch_size
+        values[start:end] = equity(model.get_output(encoder.encode_batch(boards[start:end], turns[start:end])))
+    return values
+
+
+def evaluate_batch(model, encoder, batch, moves, batch_size=4096, all_moves=False):
+    """
+    Result rows of a batch of (board, turn, roll) and their moves from
+    afterstates (None without a roll). Equities are for the player on roll.
+    """
+    boards = np.array([board for board, _, _ in batch])
+    turns = np.array([turn for _, turn, _ in batch])
+    sign = np.where(turns == 0, -1., 1.)
+    values = sign * _equities(model, encoder, boards, turns, batch_size)
+
+    # every afterstate of the batch in one pass, evaluated with the
+    # opponent to move
+    generated = [m for m in moves if m is not None and len(m[0])]
+    move_values = []
+    if generated:
+        after = np.concatenate([m[1] for m in generated])
+        after_turns = np.concatenate([np.full(len(m[0]), 1 - turn)
+                                      for m, (_, turn, _) in zip(moves, batch) if m is not None and len(m[0])])
+        after_values = _equities(model, encoder, after, after_turns, batch_size)
+        move_values = np.split(after_values, np.cumsum([len(m[0]) for m in generated])[:-1])
+
+    rows, k = [], 0
+    for i, ((board, turn, roll), m) in enumerate(zip(batch, moves)):
+        row = {'id': position_id(board, turn), 'player': Game.TOKENS[turn],
+               'roll': '%d%d' % roll if roll else '', 'equity': float(values[i]), 'move': '', 'move_equity': None}
+        if m is not None and len(m[0]):
+            v = move_values[k] * sign[i]
+            k += 1
+            best = int(np.argmax(v))
+            row['move'], row['move_equity'] = move_text(m[0][best]), float(v[best])
+            if all_moves:
+                order = np.argsort(-v, kind='stable')
+                row['moves'] = [[move_text(m[0][j]), float(v[j])] for j in order]
+        rows.append(row)
+    return rows
+
+
+def analyze(model, positions, batch_size=4096, workers=None, all_rolls=False, all_moves=False):
+    """
+    Stream result rows for an iterable of (board, turn, roll). Positions
+    without a roll get their equity only, or a row for each of the 21
+    rolls with all_rolls. Move generation runs on workers processes
+    (inline with 1), batch_size positions at a time, with a bounded
+    number of batches read ahead.
+    """
+    encoder = getattr(model, 'encoder', None)
+    if encoder is None:
+        from backgammon.features import get_encoder
+        encoder = get_encoder('td198')
+
+    batches = _batches(_expand(positions, all_rolls), batch_size)
+    if workers == 1:
+        for batch in batches:
+            for row in evaluate_batch(model, encoder, *_generate(batch), batch_size=batch_size,
+                                      all_moves=all_moves):
+                yield row
+        return
+
+    pool = multiprocessing.Pool(workers)
+    # at most max_pending batches are read ahead, so the input is
+    # consumed as fast as the results are and memory stays bounded
+    max_pending = 2 * (workers or multiprocessing.cpu_count())
+    pending = collections.deque()
+    try:
+        while True:
+            # the pool generates the next batches while the network
+            # evaluates this one
+            while len(pending) < max_pending:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.append(pool.apply_async(_generate, (batch,)))
+            if not pending:
+                break
+            batch, moves = pending.popleft().get()
+            for row in evaluate_batch(model, encoder, batch, moves, batch_size=batch_size, all_moves=all_moves):
+                yield row
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write(rows, out, fmt='jsonl'):
+    """
+    Write result rows to the file out as JSON lines or CSV, returns the
+    number of rows.
+    """
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(FIELDS[:-1])
+        for row in rows:
+            writer.writerow(['' if row[name] is None else row[name] for name in FIELDS[:-1]])
+            count += 1
+    elif fmt == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(row, sort_keys=True) + '\n')
+            count += 1
+    else:
+        raise ValueError('Unknown format %s, expected jsonl or csv' % fmt)
+    return count
@@ -0,0 +1,179 @@
+import time
+
+import numpy as np
+
+from ..features import outcome_targets
+from .td_gammon_agent import TDAgent, equity, prefilter
+
+# the 21 different rolls and their probabilities
+ROLLS = [((a, b), (1. if a == b else 2.) / 36.) for a in range(1, 7) for b in range(a, 7)]
+
+
+class Timeout(Exception):
+    pass
+
+
+def average(mean, value, rate=0.1):
+    return value if mean is None else (1. - rate) * mean + rate * value
+
+
+class AnytimeAgent(TDAgent):
+
+    def __init__(self, player, model, time_limit=0.1, max_ply=2, beams=(8, 3), chunk=64, histogram=None):
+        """
+        Returns the best move found when time_limit seconds have passed.
+        Moves are ranked by the prefilter, evaluated at 0-ply in chunks of
+        chunk moves in that order, then the best beams[0] moves are
+        searched again at 1-ply, the best beams[1] of those at 2-ply, and
+        so on up to max_ply. Replies inside the search are chosen at
+        0-ply. A search cut by the deadline is used if it compared at
+        least two moves. histogram (see metrics.LatencyHistogram) records
+        the time of every decision.
+        """
+        super(AnytimeAgent, self).__init__(player, model)
+        self.name = 'TD-Gammon (anytime)'
+        self.time_limit = time_limit
+        self.max_ply = max_ply
+        self.beams = list(beams)
+        self.chunk = chunk
+        self.histogram = histogram
+        # outputs of the network, for the equity of finished games
+        sizes = getattr(model, 'layer_sizes', None)
+        self.outputs = sizes[-1] if sizes else 1
+        # moving averages of the seconds per move of the prefilter and of
+        # the search at every ply, used to avoid starting work that cannot
+        # finish before the deadline
+        self.prefilter_cost = None
+        self.search_costs = {}
+        # decisions by deepest completed stage
+        self.depths = dict((name, 0) for name in ['prefilter'] + ['%d-ply' % p for p in range(max_ply + 1)])
+
+    def get_action(self, actions, game):
+        if not actions:
+            return None
+
+        start_ts = time.time()
+        deadline = start_ts + self.time_limit
+        actions = list(actions)
+        if len(actions) == 1:
+            return actions[0]
+
+        order = np.arange(len(actions))
+        boards = None
+        if len(actions) > self.chunk and (self.prefilter_cost is None or
+                                          len(actions) * self.prefilter_cost < self.time_limit / 4.):
+            ts = time.time()
+            # the 0-ply evaluation reuses the afterstate boards
+            boards = game.afterstate_boards(actions, self.player)
+            order = np.argsort(-prefilter(game, actions, self.player, boards), kind='stable')
+            self.prefilter_cost = average(self.prefilter_cost, (time.time() - ts) / len(actions))
+        best, depth = actions[order[0]], 'prefilter'
+
+        values = np.full(len(actions), -np.inf)
+        deep = {}
+        try:
+            i = 0
+            while i < len(actions):
+                size = self.chunk
+                if self.cost:
+                    size = min(size, int((deadline - time.time()) / self.cost))
+                if size < 1:
+                    raise Timeout()
+                chunk = order[i:i + size]
+                ts = time.time()
+                values[chunk] = self.values(game, [actions[j] for j in chunk], self.player,
+                                            None if boards is None else boards[chunk])
+                self.cost = average(self.cost, (time.time() - ts) / len(chunk))
+                best = actions[int(np.argmax(values))]
+                i += size
+            depth = '0-ply'
+
+            ranked = list(np.argsort(-values, kind='stable'))
+            for ply in range(1, self.max_ply + 1):
+                beam = ranked[:self.beams[min(ply, len(self.beams)) - 1]]
+                if len(beam) < 2:
+                    break
+                deep = {}
+                for j in beam:
+                    ts = time.time()
+                    if ts + self.search_costs.get(ply, 0.) > deadline:
+                        raise Timeout()
+                    try:
+                        deep[j] = self.search(game, actions[j], ply, deadline)
+                    except Timeout:
+                        # the search costs at least that much
+                        self.search_costs[ply] = max(self.search_costs.get(ply, 0.), time.time() - ts)
+                        raise
+                    self.search_costs[ply] = average(self.search_costs.get(ply), time.time() - ts)
+                ranked = sorted(beam, key=lambda j: -deep[j])
+                best, depth = actions[ranked[0]], '%d-ply' % ply
+                deep = {}
+        except Timeout:
+            if len(deep) >= 2:
+                best = actions[max(deep, key=deep.get)]
+
+        self.depths[depth] += 1
+        if self.histogram is not None:
+            self.histogram.add(time.time() - start_ts)
+        return best
+
+    def check(self, deadline):
+        if time.time() > deadline:
+            raise Timeout()
+
+    def search(self, game, action, ply, deadline):
+        """
+        Equity for self.player of action, looking ply rolls ahead.
+        """
+        ateList = game.take_action(action, self.player)
+        try:
+            v = self.expectation(game, game.opponent(self.player), ply, deadline)
+        finally:
+            game.undo_action(action, self.player, ateList)
+        return v if self.player == game.players[1] else -v
+
+    def expectation(self, game, mover, ply, deadline):
+        """
+        Equity for players[1] of game with mover to roll, averaged over
+        the rolls, mover playing its best 0-ply reply.
+        """
+        if game.is_over():
+            return float(equity(outcome_targets(game, self.outputs))[0])
+
+        opponent = game.opponent(mover)
+        total = 0.
+        for roll, p in ROLLS:
+            self.check(deadline)
+            actions = list(game.get_actions_doubles(roll, mover, nodups=True))
+            if not actions:
+                if ply > 1:
+                    v = self.expectation(game, opponent, ply - 1, deadline)
+                else:
+                    v = self.static(game, opponent)
+            else:
+                # doubles can have hundreds of replies, check the deadline
+                # between chunks of them
+                values = np.empty(len(actions))
+                for i in range(0, len(actions), self.chunk):
+                    if i:
+                        self.check(deadline)
+                    values[i:i + self.chunk] = self.values(game, actions[i:i + self.chunk], mover)
+                k = int(np.argmax(values))
+                if ply > 1:
+                    ateList = game.take_action(actions[k], mover)
+                    try:
+                        v = self.expectation(game, opponent, ply - 1, deadline)
+                    finally:
+                        game.undo_action(actions[k], mover, ateList)
+                else:
+                    v = values[k] if mover == game.players[1] else -values[k]
+            total += p * v
+        return total
+
+    def static(self, game, mover):
+        """
+        Equity for players[1] of game with mover to roll, without lookahead.
+        """
+        encoder = getattr(self.model, 'encoder', None)
+        x = encoder.encode(game, mover) if encoder is not None else game.extract_features(mover)
+        return float(equity(self.model.get_output(x))[0])
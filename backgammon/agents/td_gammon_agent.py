@@ -1,32 +1,107 @@
+import time
+
 import numpy as np
 
+# prefilter score of the Game.move_heuristics columns: pips gained, blots
+# and points made
+PREFILTER_WEIGHTS = np.array([0.1, -1., 1.])
+MIN_CANDIDATES = 2
+
+
+def equity(output):
+    """
+    Cubeless equity for players[1] of a batch of network outputs, see
+    backgammon.features.OUTPUTS. Missing outputs count as 0, so a single
+    output network gives 2 * win - 1.
+    """
+    output = np.asarray(output).reshape(len(output), -1)
+    weights = np.array([2., 1., 1., -1., -1.])[:output.shape[1]]
+    return np.dot(output, weights) - 1.
+
+
+def prefilter(game, actions, player, boards=None):
+    """
+    Cheap score of each action, higher is better. boards are the
+    afterstate boards of actions when the caller has them.
+    """
+    return np.dot(game.move_heuristics(actions, player, boards), PREFILTER_WEIGHTS)
+
+
 class TDAgent(object):
 
-    def __init__(self, player, model):
+    def __init__(self, player, model, top_k=None, time_budget=None):
+        """
+        With top_k or time_budget (seconds per move), the moves are first
+        ranked by the prefilter and only the best ones are evaluated by
+        the network: at most top_k, and as many as the time left after
+        the prefilter allows at the measured cost of an evaluation. The
+        prefilter is skipped when it costs more than the evaluations it
+        would save.
+        """
         self.player = player
         self.model = model
         self.name = 'TD-Gammon'
+        self.top_k = top_k
+        self.time_budget = time_budget
+        # seconds per evaluated move and per prefiltered move, moving
+        # averages
+        self.cost = None
+        self.prefilter_cost = None
+
+    def candidates(self, actions, game):
+        """
+        Actions worth evaluating with the network, and their afterstate
+        boards when the prefilter built them (None otherwise).
+        """
+        k = self.top_k or len(actions)
+        if self.time_budget is not None and self.cost:
+            k = min(k, max(MIN_CANDIDATES, int(self.time_budget / self.cost)))
+        if len(actions) <= k:
+            return actions, None
+        if self.cost and self.prefilter_cost and len(actions) * self.prefilter_cost >= (len(actions) - k) * self.cost:
+            return actions, None
+
+        start_ts = time.time()
+        boards = game.afterstate_boards(actions, self.player)
+        scores = prefilter(game, actions, self.player, boards)
+        elapsed = time.time() - start_ts
+        cost = elapsed / len(actions)
+        self.prefilter_cost = cost if self.prefilter_cost is None else 0.9 * self.prefilter_cost + 0.1 * cost
+        if self.time_budget is not None and self.cost:
+            # the prefilter used part of the budget
+            k = min(k, max(MIN_CANDIDATES, int((self.time_budget - elapsed) / self.cost)))
+        best = np.argpartition(-scores, k - 1)[:k]
+        return [actions[i] for i in best], boards[best]
 
     def get_action(self, actions, game):
         """
         Return best action according to self.evaluationFunction,
         with no lookahead.
         """
-        v_best = 0
-        a_best = None
+        if not actions:
+            return None
 
-        for a in actions:
-            ateList = game.take_action(a, self.player)
-            features = game.extract_features(game.opponent(self.player))
-            v = self.model.get_output(features)
+        actions, boards = self.candidates(list(actions), game)
+        start_ts = time.time()
+        v = self.values(game, actions, self.player, boards)
 
-            v = 1. - v if self.player == game.players[0] else v
+        cost = (time.time() - start_ts) / len(actions)
+        self.cost = cost if self.cost is None else 0.9 * self.cost + 0.1 * cost
 
-            if v > v_best:
-                v_best = v
-                a_best = a
+        return actions[int(np.argmax(v))]
 
-            game.undo_action(a, self.player, ateList)
+    def values(self, game, actions, player, boards=None):
+        """
+        Equity of the position reached by each action, for player. boards
+        are the afterstate boards of actions when the caller has them.
+        """
+        if hasattr(self.model, 'evaluate_actions'):
+            # incremental evaluation, only the changed board cells are applied
+            v = self.model.evaluate_actions(game, actions, player)
+        else:
+            # evaluate every afterstate in a single batch
+            features = game.afterstate_features(actions, player, getattr(self.model, 'encoder', None), boards)
+            v = self.model.get_output(features)
 
-        # print("a_best {}".format(a_best))
-        return a_best
+        v = equity(v)
+        return -v if player == game.players[0] else v
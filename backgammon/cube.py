@@ -0,0 +1,190 @@
+"""
+Doubling cube decisions for money and match play.
+
+The network gives cubeless outcome probabilities (see features.OUTPUTS).
+They are turned into cube decisions with a dead cube model: the equity of
+no double at the current cube, of double/take at twice the cube and of
+double/pass, in points for money games or in match winning chances using
+the match equity table. The table and the equities of every outcome at a
+given score and cube are cached, so a decision costs one batched network
+evaluation plus a few dot products.
+"""
+from __future__ import division
+
+import functools
+
+import numpy as np
+
+from .game import Game
+from .features import get_encoder
+
+
+@functools.lru_cache(maxsize=None)
+def match_equity_table(length, gammon_rate=0.26, backgammon_rate=0.01):
+    """
+    met[a, b] is the probability of winning the match for a player who
+    needs a points against an opponent who needs b, when every game is an
+    even game ending in a gammon or backgammon at the given rates.
+    """
+    single = (1. - gammon_rate - backgammon_rate) / 2.
+    outcomes = [(1, single), (2, gammon_rate / 2.), (3, backgammon_rate / 2.)]
+
+    met = np.zeros((length + 1, length + 1))
+    met[0, 1:] = 1.
+    for a in range(1, length + 1):
+        for b in range(1, length + 1):
+            met[a, b] = sum(p * (met[max(a - k, 0), b] + met[a, max(b - k, 0)]) for k, p in outcomes)
+    met.setflags(write=False)
+    return met
+
+
+def _match_equity(met, need, opponent_need):
+    if need <= 0:
+        return 1.
+    if opponent_need <= 0:
+        return 0.
+    return met[need, opponent_need]
+
+
+@functools.lru_cache(maxsize=None)
+def outcome_equities(need, opponent_need, cube, length):
+    """
+    Equity of the player on roll after each outcome (win 1, 2, 3 points,
+    lose 1, 2, 3 points) times the cube, and the equity of a pass. For a
+    money game (length 0) equities are in points.
+    """
+    if not length:
+        return np.array([1., 2., 3., -1., -2., -3.]) * cube, float(cube)
+    met = match_equity_table(length)
+    equities = [_match_equity(met, need - k * cube, opponent_need) for k in (1, 2, 3)]
+    equities += [_match_equity(met, need, opponent_need - k * cube) for k in (1, 2, 3)]
+    return np.array(equities), _match_equity(met, need - cube, opponent_need)
+
+
+@functools.lru_cache(maxsize=None)
+def take_point(need, opponent_need, cube, length):
+    """
+    Minimum gammonless winning chances the taker needs to take a double
+    from a player on roll with the given score and cube.
+    """
+    double_pass = outcome_equities(need, opponent_need, cube, length)[1]
+    equities = outcome_equities(need, opponent_need, 2 * cube, length)[0]
+    win, lose = equities[0], equities[3]
+    # the doubler is indifferent when its double/take equity equals a pass
+    doubler_win = (double_pass - lose) / (win - lose)
+    return 1. - doubler_win
+
+
+def outcome_probabilities(outputs):
+    """
+    Exclusive outcome probabilities (win single, gammon, backgammon, lose
+    single, gammon, backgammon) from the cumulative network outputs.
+    """
+    outputs = np.asarray(outputs, dtype=np.float64)
+    padded = np.zeros((len(outputs), 5))
+    padded[:, :outputs.shape[1]] = outputs
+    win, win_g, win_bg, lose_g, lose_bg = padded.T
+    lose = 1. - win
+    return np.stack([win - win_g, win_g - win_bg, win_bg, lose - lose_g, lose_g - lose_bg, lose_bg], axis=1)
+
+
+class CubefulEvaluator(object):
+    def __init__(self, model):
+        """
+        Cube decisions from the outputs of model (anything with
+        get_output), evaluated before the roll of the player on turn.
+        """
+        self.model = model
+        self.encoder = getattr(model, 'encoder', None) or get_encoder('td198')
+
+    def probabilities(self, games, players):
+        """
+        Outcome probabilities of each game for the matching player, in a
+        single batched evaluation.
+        """
+        boards = np.array([game.board_array() for game in games])
+        turns = np.array([game.players.index(p) for game, p in zip(games, players)])
+        outputs = self.model.get_output(self.encoder.encode_batch(boards, turns))
+        probabilities = outcome_probabilities(outputs)
+        # the outputs are for players[1], swap the win and loss columns
+        # for the others
+        flip = turns == 0
+        probabilities[flip] = probabilities[flip][:, [3, 4, 5, 0, 1, 2]]
+        return probabilities
+
+    def decide(self, games, players):
+        """
+        Cube decision of each player on roll, as a dict with the action
+        ('no double', 'double/take', 'double/pass' or 'too good'), whether
+        the opponent should take, and the three equities.
+        """
+        decisions = []
+        for game, player, p in zip(games, players, self.probabilities(games, players)):
+            opponent = game.opponent(player)
+            need = game.match_length - game.score[player]
+            opponent_need = game.match_length - game.score[opponent]
+            length = game.match_length
+
+            equities, double_pass = outcome_equities(need, opponent_need, game.cube_value, length)
+            no_double = np.dot(p, equities)
+            double_take = np.dot(p, outcome_equities(need, opponent_need, 2 * game.cube_value, length)[0])
+
+            take = double_take < double_pass
+            if min(double_take, double_pass) > no_double:
+                action = 'double/take' if take else 'double/pass'
+            elif not take and no_double > double_pass:
+                action = 'too good'
+            else:
+                action = 'no double'
+
+            decisions.append({
+                'action': action,
+                'take': bool(take),
+                'no_double': float(no_double),
+                'double_take': float(double_take),
+                'double_pass': float(double_pass),
+                'take_point': float(take_point(need, opponent_need, game.cube_value, length)),
+            })
+        return decisions
+
+
+def play_game(game, players, evaluator=None):
+    """
+    Play game like Game.play, with the player on roll considering a
+    double before each roll when an evaluator is given. The same
+    evaluator answers for the opponent.
+    """
+    player_num = game.rng.randint(0, 1)
+    while not game.is_over():
+        player = players[player_num]
+        if evaluator is not None and game.can_double(player.player):
+            decision = evaluator.decide([game], [player.player])[0]
+            if decision['action'].startswith('double'):
+                game.double(player.player, decision['take'])
+                if game.is_over():
+                    break
+        game.next_step(player, player_num)
+        player_num = (player_num + 1) % 2
+    return game.winner()
+
+
+def play_match(players, length, evaluator=None, rng=None):
+    """
+    Play a match to length points, with the Crawford rule, and return the
+    final score and the finished games. A length of 0 plays a single money
+    game.
+    """
+    score = dict((t, 0) for t in Game.TOKENS)
+    crawford_played = False
+    games = []
+    while not games or max(score.values()) < length:
+        game = Game.new(rng=rng)
+        game.match_length = length
+        game.score = dict(score)
+        game.crawford = not crawford_played and any(length - s == 1 for s in score.values())
+        crawford_played = crawford_played or game.crawford
+
+        winner = play_game(game, players, evaluator)
+        score[game.players[winner]] += game.points()
+        games.append(game)
+    return score, games
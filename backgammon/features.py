@@ -0,0 +1,140 @@
+"""
+Registry of input encoders for the network.
+
+Every encoder has a size, a vectorized encode_batch working on a batch of
+board arrays (see Game.board_array) and the index of the player the
+features are seen from, and an encode(game, player) helper for a single
+game returning a (1, size) array like Game.extract_features.
+"""
+import numpy as np
+
+from .game import Game
+
+# network outputs, always seen from players[1]; a network with n outputs
+# predicts the first n of them
+OUTPUTS = ['win', 'win_gammon', 'win_backgammon', 'lose_gammon', 'lose_backgammon']
+
+
+class Encoder(object):
+    name = None
+    size = None
+
+    def encode_batch(self, boards, turns):
+        raise NotImplementedError
+
+    def encode(self, game, player):
+        boards = game.board_array()[np.newaxis]
+        turns = np.array([game.players.index(player)])
+        return self.encode_batch(boards, turns)
+
+
+def _turn_features(turns):
+    turns = np.asarray(turns)
+    return np.stack([turns == 0, turns == 1], axis=1).astype(np.float32)
+
+
+class TDGammon198(Encoder):
+    """
+    Tobias Vogt's encoding used by Game.extract_features: 4 units per point
+    (0000, 1000, 1100, 1110, 1110.5, 1111 for 0 to 5 pieces), bar / 2 and
+    off / 15 for each player, plus 2 units for the player.
+    """
+    name = 'td198'
+    size = 198
+
+    def encode(self, game, player):
+        return game.extract_features(player)
+
+    def encode_batch(self, boards, turns):
+        c = boards[:, :, :Game.NUMCOLS].astype(np.float32)
+        points = np.stack([c >= 1, c >= 2, c >= 3, np.maximum(c - 3., 0.) / 2.], axis=-1)
+        n = len(boards)
+        per_player = np.concatenate([
+            points.reshape(n, 2, -1),
+            boards[:, :, Game.NUMCOLS:Game.NUMCOLS + 1] / 2.,
+            boards[:, :, Game.NUMCOLS + 1:] / 15.], axis=2)
+        return np.concatenate([per_player.reshape(n, -1), _turn_features(turns)], axis=1).astype(np.float32)
+
+
+class TDGammon294(Encoder):
+    """
+    The original TD-Gammon encoding: 6 units per point (one per piece for
+    the first five, then the surplus), bar / 2 and off / 15 for each
+    player, plus 2 units for the player.
+    """
+    name = 'td294'
+    size = 294
+
+    def encode_batch(self, boards, turns):
+        c = boards[:, :, :Game.NUMCOLS].astype(np.float32)
+        points = [c > k for k in range(5)] + [np.maximum(c - 5., 0.)]
+        points = np.stack(points, axis=-1)
+        n = len(boards)
+        per_player = np.concatenate([
+            points.reshape(n, 2, -1),
+            boards[:, :, Game.NUMCOLS:Game.NUMCOLS + 1] / 2.,
+            boards[:, :, Game.NUMCOLS + 1:] / 15.], axis=2)
+        return np.concatenate([per_player.reshape(n, -1), _turn_features(turns)], axis=1).astype(np.float32)
+
+
+def pip_counts(boards):
+    """
+    (n, 2) pip counts, players[0] moves up the grid and players[1] down.
+    """
+    c = boards[:, :, :Game.NUMCOLS].astype(np.int32)
+    distance = np.arange(Game.NUMCOLS)
+    pips0 = np.dot(c[:, 0], Game.NUMCOLS - distance)
+    pips1 = np.dot(c[:, 1], distance + 1)
+    bar = boards[:, :, Game.NUMCOLS].astype(np.int32) * (Game.NUMCOLS + 1)
+    return np.stack([pips0, pips1], axis=1) + bar
+
+
+def longest_primes(boards):
+    """
+    (n, 2) length of the longest run of consecutive made points.
+    """
+    made = boards[:, :, :Game.NUMCOLS] >= 2
+    run = np.zeros(made.shape[:2], dtype=np.int32)
+    longest = np.zeros_like(run)
+    for i in range(Game.NUMCOLS):
+        run = np.where(made[:, :, i], run + 1, 0)
+        longest = np.maximum(longest, run)
+    return longest
+
+
+class Extended(TDGammon198):
+    """
+    td198 plus pip count / 167, number of blots / 15 and longest prime / 6
+    for each player.
+    """
+    name = 'extended'
+    size = 204
+
+    def encode(self, game, player):
+        return Encoder.encode(self, game, player)
+
+    def encode_batch(self, boards, turns):
+        base = TDGammon198.encode_batch(self, boards, turns)
+        blots = (boards[:, :, :Game.NUMCOLS] == 1).sum(axis=2)
+        extra = np.concatenate([pip_counts(boards) / 167., blots / 15., longest_primes(boards) / 6.], axis=1)
+        return np.concatenate([base, extra], axis=1).astype(np.float32)
+
+
+ENCODERS = dict((cls.name, cls()) for cls in [TDGammon198, TDGammon294, Extended])
+
+
+def get_encoder(name):
+    if name not in ENCODERS:
+        raise ValueError('Unknown encoder %s, expected one of %s' % (name, sorted(ENCODERS)))
+    return ENCODERS[name]
+
+
+def outcome_targets(game, outputs=1):
+    """
+    Training targets of a finished game for a network with outputs units.
+    """
+    won = game.winner() == 1
+    win_type = game.win_type()
+    targets = [won, won and win_type >= 2, won and win_type == 3,
+               not won and win_type >= 2, not won and win_type == 3]
+    return np.array([targets[:outputs]], dtype='float')
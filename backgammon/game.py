@@ -12,15 +12,32 @@ class Game:
     OFF = 'off'
     ON = 'on'
 
+    # integer codes used by the packed move arrays
+    ON_CODE = 24
+    OFF_CODE = 25
+    NO_MOVE = -1
+    MAX_STEPS = 4
+    NUM_FEATURES = 198
+
     TOKENS = ['o', 'x']
 
     def __init__(self, layout=LAYOUT, grid=None, off_pieces=None,
-                 bar_pieces=None, num_pieces=None, players=None):
+                 bar_pieces=None, num_pieces=None, players=None, rng=None):
         """
-        Define a new game object
+        Define a new game object, rng is the random generator used for
+        the dice (defaults to the random module)
         """
         self.die = Game.QUAD
         self.layout = layout
+        self.rng = rng if rng is not None else random
+        # doubling cube, dropped is the player who passed a double
+        self.cube_value = 1
+        self.cube_owner = None
+        self.dropped = None
+        # match score, a match_length of 0 is a money game
+        self.match_length = 0
+        self.score = dict((t, 0) for t in Game.TOKENS)
+        self.crawford = False
         if grid:
             self.grid = copy.deepcopy(grid)
             self.off_pieces = copy.deepcopy(off_pieces)
@@ -39,8 +56,8 @@ class Game:
             self.num_pieces[t] = 0
 
     @staticmethod
-    def new():
-        game = Game()
+    def new(rng=None):
+        game = Game(rng=rng)
         game.reset()
         return game
 
@@ -82,19 +99,7 @@ class Game:
         for p in self.players:
             # 24 mögliche Brettpositionen
             for col in self.grid:
-                # 4 Features kodieren eine Stelle auf dem Spielbrett
-                feats = [0.] * 4
-                if len(col) > 0 and col[0] == p:
-                    # 0,1,2,3,4,5 Steine werden kodiert als
-                    # 0000, 1000, 1100, 1110, 1110.5, 1111
-                    # (4. Bit = (n-3)/2)
-                    for i in range(len(col)):
-                        if i < 3:
-                            feats[i] += 1
-                        else:
-                            feats[3] = (len(col)-3)/2.0
-                            break
-                features += feats
+                features += Game.point_features(col, p)
             # Anzahl der Steine auf der "Bar", n/2
             features.append(float(len(self.bar_pieces[p])) / 2.)
             # Anzahl der Steine die bereits aus dem Spiel sind, n/15
@@ -106,11 +111,59 @@ class Game:
             features += [0., 1.]
         return np.array(features).reshape(1, -1)
 
+    @staticmethod
+    def point_features(col, p):
+        """
+        The 4 features encoding the pieces of p on one point of the grid.
+        """
+        # 4 Features kodieren eine Stelle auf dem Spielbrett
+        feats = [0.] * 4
+        if len(col) > 0 and col[0] == p:
+            # 0,1,2,3,4,5 Steine werden kodiert als
+            # 0000, 1000, 1100, 1110, 1110.5, 1111
+            # (4. Bit = (n-3)/2)
+            for i in range(len(col)):
+                if i < 3:
+                    feats[i] += 1
+                else:
+                    feats[3] = (len(col)-3)/2.0
+                    break
+        return feats
+
+    def board_array(self):
+        """
+        Piece counts as a (2, 26) int8 array, one row per player in
+        self.players order: the 24 points, then bar and off.
+        """
+        board = np.zeros((2, Game.NUMCOLS + 2), dtype=np.int8)
+        for k, p in enumerate(self.players):
+            for i, col in enumerate(self.grid):
+                if len(col) > 0 and col[0] == p:
+                    board[k, i] = len(col)
+            board[k, Game.NUMCOLS] = len(self.bar_pieces[p])
+            board[k, Game.NUMCOLS + 1] = len(self.off_pieces[p])
+        return board
+
+    @staticmethod
+    def from_board_array(board, rng=None):
+        """
+        Game in the position of a board array from board_array.
+        """
+        game = Game(rng=rng)
+        for k, p in enumerate(game.players):
+            for i in range(Game.NUMCOLS):
+                if board[k, i] > 0:
+                    game.grid[i] = [p] * int(board[k, i])
+            game.bar_pieces[p] = [p] * int(board[k, Game.NUMCOLS])
+            game.off_pieces[p] = [p] * int(board[k, Game.NUMCOLS + 1])
+            game.num_pieces[p] = int(board[k].sum())
+        return game
+
     def roll_dice(self):
-        return (random.randint(1, self.die), random.randint(1, self.die))
+        return (self.rng.randint(1, self.die), self.rng.randint(1, self.die))
 
     def play(self, players, draw=False):
-        player_num = random.randint(0, 1)
+        player_num = self.rng.randint(0, 1)
         while not self.is_over():
             self.next_step(players[player_num], player_num, draw=draw)
             player_num = (player_num + 1) % 2
@@ -145,8 +198,15 @@ class Game:
         Return an exact copy of the game. Changes can be made
         to the cloned version without affecting the original.
         """
-        return Game(None, self.grid, self.off_pieces,
-                    self.bar_pieces, self.num_pieces, self.players)
+        game = Game(None, self.grid, self.off_pieces,
+                    self.bar_pieces, self.num_pieces, self.players, self.rng)
+        game.cube_value = self.cube_value
+        game.cube_owner = self.cube_owner
+        game.dropped = self.dropped
+        game.match_length = self.match_length
+        game.score = dict(self.score)
+        game.crawford = self.crawford
+        return game
 
     def take_action(self, action, token):
         """
@@ -281,6 +341,229 @@ class Game:
 
         return moves
 
+    def get_actions_array(self, roll, player, afterstates=False):
+        """
+        Packed version of get_actions_doubles.
+
+        Returns an int8 array of shape (n, MAX_STEPS, 2) with the
+        (start, end) of every step of every legal move. The bar and the
+        tray are written as ON_CODE / OFF_CODE and unused steps are
+        padded with NO_MOVE. If afterstates is True, also returns the
+        (n, NUM_FEATURES) feature batch of the positions reached by the
+        moves, as seen by the opponent (what TDAgent evaluates).
+        """
+        r1, r2 = roll
+        if player == self.players[1]:
+            r1, r2 = -r1, -r2
+
+        # every move is written into one row of step codes, and kept as
+        # its bytes, so no tuple is built per step or per move
+        row = bytearray(b'\xff' * (2 * Game.MAX_STEPS))
+        moves = {}
+        if r1 == r2:
+            i = 4
+            while not moves and i > 0:
+                self.find_packed_moves((r1,) * i, player, row, 0, moves)
+                i -= 1
+        else:
+            self.find_packed_moves((r1, r2), player, row, 0, moves)
+            self.find_packed_moves((r2, r1), player, row, 0, moves)
+            if not moves:
+                for r in (r1, r2):
+                    self.find_packed_moves((r,), player, row, 0, moves)
+
+        encoded = np.frombuffer(b''.join(moves), dtype=np.int8).reshape(len(moves), Game.MAX_STEPS, 2)
+        if afterstates:
+            if not len(encoded):
+                return encoded, np.zeros((0, Game.NUM_FEATURES), dtype=np.float32)
+            boards = self.packed_afterstate_boards(encoded, player)
+            return encoded, self.afterstate_features(None, player, boards=boards)
+        return encoded
+
+    def find_packed_moves(self, rs, player, row, depth, moves):
+        """
+        find_moves writing the steps of the current move into row, a
+        bytearray of int8 step codes, and collecting the finished rows as
+        keys of moves. Follows the same rules, see get_actions_array.
+        """
+        if depth == len(rs):
+            moves[bytes(row)] = None
+            return
+        r = rs[depth]
+        k = 2 * depth
+        opponent = self.opponent(player)
+
+        if self.bar_pieces[player] and self.can_onboard(player, r):
+            end = r - 1 if player == self.players[0] else Game.NUMCOLS + r
+            piece = self.bar_pieces[player].pop()
+            bar_piece = None
+            if len(self.grid[end]) == 1 and self.grid[end][-1] != player:
+                bar_piece = self.grid[end].pop()
+                self.bar_pieces[opponent].append(bar_piece)
+            self.grid[end].append(piece)
+
+            row[k], row[k + 1] = Game.ON_CODE, end
+            self.find_packed_moves(rs, player, row, depth + 1, moves)
+            row[k] = row[k + 1] = 0xff
+
+            self.grid[end].pop()
+            self.bar_pieces[player].append(piece)
+            if bar_piece:
+                self.grid[end].append(bar_piece)
+                self.bar_pieces[opponent].pop()
+            return
+
+        offboarding = self.can_offboard(player)
+        for i in range(Game.NUMCOLS):
+            if self.is_valid_move(i, i + r, player):
+                piece = self.grid[i].pop()
+                bar_piece = None
+                if len(self.grid[i + r]) == 1 and self.grid[i + r][-1] != player:
+                    bar_piece = self.grid[i + r].pop()
+                    self.bar_pieces[opponent].append(bar_piece)
+                self.grid[i + r].append(piece)
+
+                row[k], row[k + 1] = i, i + r
+                self.find_packed_moves(rs, player, row, depth + 1, moves)
+                row[k] = row[k + 1] = 0xff
+
+                self.grid[i + r].pop()
+                self.grid[i].append(piece)
+                if bar_piece:
+                    self.grid[i + r].append(bar_piece)
+                    self.bar_pieces[opponent].pop()
+
+            if offboarding and self.remove_piece(player, i, r):
+                piece = self.grid[i].pop()
+                self.off_pieces[player].append(piece)
+
+                row[k], row[k + 1] = i, Game.OFF_CODE
+                self.find_packed_moves(rs, player, row, depth + 1, moves)
+                row[k] = row[k + 1] = 0xff
+
+                self.off_pieces[player].pop()
+                self.grid[i].append(piece)
+
+    @staticmethod
+    def encode_actions(actions):
+        """
+        Pack a sequence of move tuples into one int8 array, see
+        get_actions_array.
+        """
+        encoded = np.full((len(actions), Game.MAX_STEPS, 2), Game.NO_MOVE, dtype=np.int8)
+        for i, action in enumerate(actions):
+            for j, (s, e) in enumerate(action):
+                encoded[i, j, 0] = Game.ON_CODE if s == Game.ON else s
+                encoded[i, j, 1] = Game.OFF_CODE if e == Game.OFF else e
+        return encoded
+
+    @staticmethod
+    def decode_action(row):
+        """
+        Turn one row of a packed move array back into the move tuple
+        accepted by take_action.
+        """
+        action = []
+        for s, e in row:
+            if s == Game.NO_MOVE:
+                break
+            s = Game.ON if s == Game.ON_CODE else int(s)
+            e = Game.OFF if e == Game.OFF_CODE else int(e)
+            action.append((s, e))
+        return tuple(action)
+
+    def afterstate_boards(self, actions, player, base=None):
+        """
+        Board arrays (see board_array) of the position reached by each
+        action, as a (n, 2, 26) batch. The steps are replayed on piece
+        counts, the game itself is not changed. base is the board_array
+        of the game when the caller has it already.
+        """
+        if base is None:
+            base = self.board_array()
+        k = self.players.index(player)
+        own, opp = k * (Game.NUMCOLS + 2), (1 - k) * (Game.NUMCOLS + 2)
+        bar, off = Game.NUMCOLS, Game.NUMCOLS + 1
+        base = base.reshape(-1).tolist()
+        boards = []
+        for action in actions:
+            after = list(base)
+            for s, e in action:
+                after[own + (bar if s == Game.ON else s)] -= 1
+                if e == Game.OFF:
+                    after[own + off] += 1
+                    continue
+                if after[opp + e] == 1:
+                    after[opp + e] = 0
+                    after[opp + bar] += 1
+                after[own + e] += 1
+            # counts are 0 to 15, so a board is 52 bytes
+            boards.append(bytes(after))
+        return np.frombuffer(b''.join(boards), dtype=np.int8).reshape(len(boards), 2, Game.NUMCOLS + 2)
+
+    def packed_afterstate_boards(self, encoded, player):
+        """
+        afterstate_boards of a packed move array from get_actions_array,
+        computed on the whole batch: ON_CODE and OFF_CODE are the bar and
+        off columns of board_array, so the pieces moved are two bincounts
+        of the step codes. An opponent blot is hit when a step ends on it.
+        """
+        k = self.players.index(player)
+        n, width = len(encoded), Game.NUMCOLS + 2
+        base = self.board_array()
+
+        moved = encoded[:, :, 0] != Game.NO_MOVE
+        rows = np.nonzero(moved)[0] * width
+        starts, ends = encoded[:, :, 0][moved], encoded[:, :, 1][moved]
+        delta = np.bincount(rows + ends, minlength=n * width) - np.bincount(rows + starts, minlength=n * width)
+
+        boards = np.repeat(base[np.newaxis], n, axis=0)
+        boards[:, k] += delta.reshape(n, width).astype(np.int8)
+        landed = np.zeros(n * width, dtype=bool)
+        landed[rows + ends] = True
+        hits = landed.reshape(n, width)[:, :Game.NUMCOLS] & (base[1 - k, :Game.NUMCOLS] == 1)
+        boards[:, 1 - k, :Game.NUMCOLS][hits] = 0
+        boards[:, 1 - k, Game.NUMCOLS] += hits.sum(axis=1).astype(np.int8)
+        return boards
+
+    def afterstate_features(self, actions, player, encoder=None, boards=None):
+        """
+        Features of the position reached by each action, from the
+        opponent's point of view, encoded as a single batch. encoder is
+        one of backgammon.features, defaults to the td198 features of
+        extract_features. boards are the afterstate_boards of actions
+        when the caller has them already.
+        """
+        if encoder is None:
+            from .features import get_encoder
+            encoder = get_encoder('td198')
+        if boards is None:
+            boards = self.afterstate_boards(actions, player)
+        turns = np.full(len(boards), self.players.index(self.opponent(player)))
+        return encoder.encode_batch(boards, turns)
+
+    def move_heuristics(self, actions, player, boards=None):
+        """
+        Cheap features of each action for move ordering, as a (n, 3)
+        array: pips gained (pips moved plus the pips of the opponent pieces
+        sent to the bar), change in blots and change in points made. They
+        are counted on the afterstate boards in one vectorized pass, boards
+        are the afterstate_boards of actions when the caller has them.
+        """
+        from .features import pip_counts
+        k = self.players.index(player)
+        base = self.board_array()
+        if boards is None:
+            boards = self.afterstate_boards(actions, player, base)
+        base = base[np.newaxis]
+
+        pips = pip_counts(boards) - pip_counts(base)
+        own = boards[:, k, :Game.NUMCOLS]
+        before = base[:, k, :Game.NUMCOLS]
+        blots = (own == 1).sum(axis=1) - (before == 1).sum()
+        points = (own > 1).sum(axis=1) - (before > 1).sum()
+        return np.stack([pips[:, 1 - k] - pips[:, k], blots, points], axis=1).astype(float)
+
     def get_actions(self, roll, player, nodups=False):
         """
         Get set of all possible move tuples original with anti clockwise
@@ -543,6 +826,8 @@ class Game:
         """
         Get winner.
         """
+        if self.dropped is not None:
+            return self.players.index(self.opponent(self.dropped))
         if len(self.off_pieces[self.players[0]]) > len(self.off_pieces[self.players[1]]):
             return 0
         elif len(self.off_pieces[self.players[0]]) < len(self.off_pieces[self.players[1]]):
@@ -558,10 +843,61 @@ class Game:
         # else :
         #     return 1
 
+    def win_type(self):
+        """
+        1 for a single game, 2 for a gammon (the loser has borne off no
+        piece), 3 for a backgammon (the loser also still has a piece on the
+        bar or in the winner's home board). A dropped double is a single game.
+        """
+        if self.dropped is not None:
+            return 1
+        winner = self.players[self.winner()]
+        loser = self.opponent(winner)
+        if len(self.off_pieces[loser]) > 0:
+            return 1
+        if winner == self.players[0]:
+            home = range(Game.NUMCOLS - self.die, Game.NUMCOLS)
+        else:
+            home = range(0, self.die)
+        if self.bar_pieces[loser] or any(len(self.grid[i]) > 0 and self.grid[i][0] == loser for i in home):
+            return 3
+        return 2
+
+    def points(self):
+        """
+        Points won by the winner of a finished game.
+        """
+        return self.cube_value * self.win_type()
+
+    def can_double(self, player):
+        """
+        Can player offer a double? Not in the Crawford game, nor with a
+        dead cube (player would already win the match at the current
+        value), nor when the opponent owns the cube.
+        """
+        if self.crawford or self.dropped is not None:
+            return False
+        if self.match_length and self.score[player] + self.cube_value >= self.match_length:
+            return False
+        return self.cube_owner is None or self.cube_owner == player
+
+    def double(self, player, take):
+        """
+        player doubles, the opponent takes (owning the cube at twice the
+        value) or drops (losing the game at the current value).
+        """
+        if take:
+            self.cube_value *= 2
+            self.cube_owner = self.opponent(player)
+        else:
+            self.dropped = self.opponent(player)
+
     def is_over(self):
         """
         Checks if the game is over.
         """
+        if self.dropped is not None:
+            return True
         for t in self.players:
             if len(self.off_pieces[t]) == self.num_pieces[t]:
                 return True
@@ -691,38 +1027,38 @@ class Game:
                 move2 = (j,j+r2)
                 moves.add((move1,move2))
 
-    def draw_col(self,i,col):
-        print ("|", end = "")
+    def draw_col(self,i,col,out=None):
+        print ("|", end = "", file = out)
         if i==-2:
             if col<10:
-                print (" ", end = "")
-            print (str(col), end = "")
+                print (" ", end = "", file = out)
+            print (str(col), end = "", file = out)
         elif i==-1:
-            print ("--", end = "")
+            print ("--", end = "", file = out)
         elif len(self.grid[col])>i:
-            print (" "+self.grid[col][i], end = "")
+            print (" "+self.grid[col][i], end = "", file = out)
         else:
-            print ("  ", end = "")
+            print ("  ", end = "", file = out)
 
-    def draw(self):
+    def draw(self, out=None):
         # os.system('clear')
         largest = max([len(self.grid[i]) for i in range(int(len(self.grid)/2),int(len(self.grid)))])
         for i in range(-2,largest):
             for col in range(int(len(self.grid)/2),int(len(self.grid))):
-                self.draw_col(i,col)
-            print ("|")
+                self.draw_col(i,col,out)
+            print ("|", file = out)
         print
         print
         largest = max([len(self.grid[i]) for i in range(int(len(self.grid)/2))])
         for i in range(largest-1,-3,-1):
             for col in range(int(len(self.grid)/2-1),-1,-1):
-                self.draw_col(i,col)
-            print ("|")
+                self.draw_col(i,col,out)
+            print ("|", file = out)
         for t in self.players:
-            print ("<Player %s>  Off Board : "%(t), end = "")
+            print ("<Player %s>  Off Board : "%(t), end = "", file = out)
             for piece in self.off_pieces[t]:
-                print (t+'', end = "")
-            print ("   Bar : ", end = "")
+                print (t+'', end = "", file = out)
+            print ("   Bar : ", end = "", file = out)
             for piece in self.bar_pieces[t]:
-                print (t+'', end = "")
+                print (t+'', end = "", file = out)
             print
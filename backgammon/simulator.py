@@ -0,0 +1,359 @@
+"""
+Fast random play, for baselines and for stress testing the rules.
+
+Games are simulated in batches on NumPy arrays instead of Game objects.
+Every board is kept from the point of view of the player to move as two
+(n, 26) count arrays, own and opponent pieces: the 24 points in the
+direction the player moves (so home is 18-23), then bar and off. Boards
+are flipped after every turn.
+
+A move is sampled one die at a time: a random legal step is chosen for
+every game of the batch at once, so the set of legal moves is never
+built. When a game cannot play all its dice this way, another order or
+choice of steps may have played more of them, so that turn is replayed
+with an exact search on the game alone (see sample_move). Moves follow
+get_actions_doubles: as many dice as possible are played, and with two
+different dice either one may be played when only one can. They are
+legal but not uniformly distributed over the legal moves.
+
+With check > 0, that fraction of the turns is also replayed on the Game
+engine and its moves are checked against the rules (see check_engine).
+"""
+from __future__ import division
+
+import time
+import multiprocessing
+
+import numpy as np
+
+from .game import Game
+
+BAR = Game.NUMCOLS
+OFF = Game.NUMCOLS + 1
+HOME = Game.NUMCOLS - Game.QUAD
+POINTS = np.arange(Game.NUMCOLS)
+
+START = Game.new().board_array()
+PIECES = int(START[0].sum())
+
+
+def flip(boards):
+    """
+    Same boards seen from the other side.
+    """
+    return np.concatenate([boards[..., Game.NUMCOLS - 1::-1], boards[..., Game.NUMCOLS:]], axis=-1)
+
+
+def physical(own, opp, mover):
+    """
+    board_array of a board seen by the player with index mover.
+    """
+    if mover == 0:
+        return np.stack([own, opp]).astype(np.int8)
+    return np.stack([flip(opp), flip(own)]).astype(np.int8)
+
+
+def step(own, opp, dice, rows, rng):
+    """
+    Play one random legal step of dice in each game of rows, returns the
+    games that could.
+    """
+    # pieces on the bar must enter first
+    on_bar = own[rows, BAR] > 0
+    entering = rows[on_bar]
+    target = dice[entering] - 1
+    can_enter = opp[entering, target] <= 1
+    entering, target = entering[can_enter], target[can_enter]
+    hit = opp[entering, target] == 1
+    own[entering, BAR] -= 1
+    own[entering, target] += 1
+    opp[entering[hit], target[hit]] = 0
+    opp[entering[hit], BAR] += 1
+
+    rows = rows[~on_bar]
+    o, p = own[rows, :Game.NUMCOLS], opp[rows, :Game.NUMCOLS]
+    dest = POINTS + dice[rows, None]
+    occupied = o > 0
+    blocked = np.take_along_axis(p, np.minimum(dest, Game.NUMCOLS - 1), axis=1) > 1
+    legal = occupied & (dest < Game.NUMCOLS) & ~blocked
+
+    # bearing off, exactly or from the rearmost point with a larger die
+    all_home = o[:, :HOME].sum(axis=1) == 0
+    behind = (np.cumsum(occupied, axis=1) - occupied) > 0
+    legal |= occupied & all_home[:, None] & ((dest == Game.NUMCOLS) | ((dest > Game.NUMCOLS) & ~behind))
+
+    movable = legal.any(axis=1)
+    choice = np.argmax(np.where(legal, rng.random_sample(legal.shape), -1.), axis=1)
+    moved, src = rows[movable], choice[movable]
+    dst = src + dice[moved]
+    own[moved, src] -= 1
+
+    bear = dst >= Game.NUMCOLS
+    own[moved[bear], OFF] += 1
+    landed, dst = moved[~bear], dst[~bear]
+    own[landed, dst] += 1
+    hit = opp[landed, dst] == 1
+    opp[landed[hit], dst[hit]] = 0
+    opp[landed[hit], BAR] += 1
+
+    return np.concatenate([entering, moved])
+
+
+def legal_steps(own, opp, die):
+    """
+    Legal (start, end) steps of one die on a single board given as lists,
+    end is OFF when bearing off.
+    """
+    if own[BAR]:
+        return [(BAR, die - 1)] if opp[die - 1] <= 1 else []
+    steps = []
+    all_home = not any(own[:HOME])
+    for i in range(Game.NUMCOLS):
+        if own[i]:
+            j = i + die
+            if j < Game.NUMCOLS:
+                if opp[j] <= 1:
+                    steps.append((i, j))
+            elif all_home and (j == Game.NUMCOLS or not any(own[HOME:i])):
+                steps.append((i, OFF))
+    return steps
+
+
+def apply_step(own, opp, s):
+    start, end = s
+    own[start] -= 1
+    own[end] += 1
+    if end < Game.NUMCOLS and opp[end] == 1:
+        opp[end] = 0
+        opp[BAR] += 1
+        return True
+    return False
+
+
+def undo_step(own, opp, s, hit):
+    start, end = s
+    own[end] -= 1
+    own[start] += 1
+    if hit:
+        opp[end] = 1
+        opp[BAR] -= 1
+
+
+def _search(own, opp, dice, rng, path, best):
+    if len(path) > len(best):
+        best[:] = path
+    if not dice:
+        return True
+    steps = legal_steps(own, opp, dice[0])
+    for k in rng.permutation(len(steps)):
+        s = steps[k]
+        hit = apply_step(own, opp, s)
+        path.append(s)
+        found = _search(own, opp, dice[1:], rng, path, best)
+        path.pop()
+        undo_step(own, opp, s, hit)
+        if found:
+            return True
+    return False
+
+
+def sample_move(own, opp, roll, rng):
+    """
+    Random legal move of a single board (lists of counts) as a list of
+    steps, found by a randomized depth first search that stops at the
+    first move playing every die.
+    """
+    d1, d2 = roll
+    if d1 == d2:
+        orders = [(d1,) * 4]
+    else:
+        orders = [(d1, d2), (d2, d1)] if rng.random_sample() < .5 else [(d2, d1), (d1, d2)]
+    best = []
+    for dice in orders:
+        if _search(own, opp, dice, rng, [], best):
+            break
+    return best
+
+
+def play_turn(own, opp, rng):
+    """
+    Roll and play a random move in every game, returns the dice.
+    """
+    n = len(own)
+    d1, d2 = rng.randint(1, Game.QUAD + 1, n), rng.randint(1, Game.QUAD + 1, n)
+    double = d1 == d2
+    swap = rng.random_sample(n) < .5
+    first, second = np.where(swap, d2, d1), np.where(swap, d1, d2)
+
+    before_own, before_opp = own.copy(), opp.copy()
+    played = np.zeros(n, dtype=np.int64)
+    everyone, doubles = np.arange(n), np.flatnonzero(double)
+    for dice, rows in [(first, everyone), (second, everyone), (first, doubles), (first, doubles)]:
+        played[step(own, opp, dice, rows, rng)] += 1
+
+    # replay exactly the turns that did not play every die
+    for i in np.flatnonzero(played < np.where(double, 4, 2)):
+        o, p = before_own[i].tolist(), before_opp[i].tolist()
+        for s in sample_move(o, p, (d1[i], d2[i]), rng):
+            apply_step(o, p, s)
+        own[i], opp[i] = o, p
+    return d1, d2
+
+
+def check_engine(own, opp, mover, roll, after, rng):
+    """
+    Replay one turn on the Game engine and return the rules its moves
+    break: 'range' (a point outside the board), 'pieces' (pieces lost or
+    two colors on a point), 'bar' (a piece moved while another is on the
+    bar), 'dice' (not the largest possible number of dice) and 'missing'
+    (the simulated move is not among the engine moves).
+    """
+    token = Game.TOKENS[mover]
+    game = Game.from_board_array(physical(own, opp, mover))
+    expected = len(sample_move(own.tolist(), opp.tolist(), roll, rng))
+
+    errors = set()
+    afterstates = set()
+    for action in game.get_actions_doubles(roll, token, nodups=True):
+        if any(s != Game.ON and not 0 <= s < Game.NUMCOLS or e != Game.OFF and not 0 <= e < Game.NUMCOLS
+               for s, e in action):
+            errors.add('range')
+            continue
+        if len(action) != expected:
+            errors.add('dice')
+        on_bar = len(game.bar_pieces[token])
+        for s, e in action:
+            if s == Game.ON:
+                on_bar -= 1
+            elif on_bar:
+                errors.add('bar')
+        ateList = game.take_action(action, token)
+        board = game.board_array()
+        if (board.sum(axis=1) != PIECES).any() or any(len(set(col)) > 1 for col in game.grid):
+            errors.add('pieces')
+        afterstates.add(board.tobytes())
+        game.undo_action(action, token, ateList)
+
+    if expected and physical(after[0], after[1], mover).tobytes() not in afterstates:
+        errors.add('missing')
+    return errors
+
+
+def simulate_batch(count, seed=None, check=0., max_turns=10000):
+    """
+    Play count random games at once, returns their lengths in turns,
+    winner index, win type (1 single, 2 gammon, 3 backgammon), the index
+    of the player who moved first and the engine rule violations found.
+    """
+    rng = np.random.RandomState(seed)
+    first = rng.randint(0, 2, count)
+    own = np.where(first[:, None] == 0, START[0], flip(START[1])).astype(np.int64)
+    opp = np.where(first[:, None] == 0, START[1], flip(START[0])).astype(np.int64)
+    mover = first.copy()
+    ids = np.arange(count)
+
+    turns = np.zeros(count, dtype=np.int64)
+    winners = np.full(count, -1, dtype=np.int64)
+    win_types = np.zeros(count, dtype=np.int64)
+    violations = {}
+
+    for turn in range(max_turns):
+        if not len(ids):
+            break
+        checked = np.flatnonzero(rng.random_sample(len(ids)) < check) if check else []
+        before = [(own[i].copy(), opp[i].copy()) for i in checked]
+
+        d1, d2 = play_turn(own, opp, rng)
+        turns[ids] += 1
+
+        for i, (o, p) in zip(checked, before):
+            for error in check_engine(o, p, mover[i], (d1[i], d2[i]), (own[i], opp[i]), rng):
+                count_error, example = violations.get(error, (0, None))
+                example = example or {'board': physical(o, p, mover[i]).tolist(),
+                                      'player': Game.TOKENS[mover[i]], 'roll': [int(d1[i]), int(d2[i])]}
+                violations[error] = (count_error + 1, example)
+
+        done = own[:, OFF] == PIECES
+        if done.any():
+            loser = opp[done]
+            gammon = loser[:, OFF] == 0
+            backgammon = gammon & ((loser[:, BAR] > 0) | (loser[:, HOME:Game.NUMCOLS].sum(axis=1) > 0))
+            winners[ids[done]] = mover[done]
+            win_types[ids[done]] = 1 + gammon + backgammon
+
+        alive = ~done
+        own, opp = flip(opp[alive]), flip(own[alive])
+        mover, ids = 1 - mover[alive], ids[alive]
+
+    return {'turns': turns, 'winners': winners, 'win_types': win_types, 'first': first,
+            'violations': violations}
+
+
+def _run_batch(task):
+    return simulate_batch(*task)
+
+
+def simulate(games, workers=None, seed=0, batch_size=1000, check=0.):
+    """
+    Play games random games in batches across workers processes and
+    summarize the game lengths and outcomes.
+    """
+    rng = np.random.RandomState(seed)
+    tasks = []
+    for start in range(0, games, batch_size):
+        tasks.append((min(batch_size, games - start), rng.randint(2 ** 31), check))
+
+    start_ts = time.time()
+    if workers == 1:
+        batches = [_run_batch(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            batches = pool.map(_run_batch, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start_ts
+
+    turns = np.concatenate([b['turns'] for b in batches])
+    winners = np.concatenate([b['winners'] for b in batches])
+    win_types = np.concatenate([b['win_types'] for b in batches])
+    first = np.concatenate([b['first'] for b in batches])
+    violations = {}
+    for b in batches:
+        for error, (count, example) in b['violations'].items():
+            total, first_example = violations.get(error, (0, example))
+            violations[error] = (total + count, first_example)
+
+    finished = winners >= 0
+    played = max(finished.sum(), 1)
+    return {
+        'games': games,
+        'unfinished': int((~finished).sum()),
+        'seconds': elapsed,
+        'games_per_sec': games / max(elapsed, 1e-9),
+        'turns_avg': float(turns[finished].mean()) if finished.any() else 0.,
+        'turns_std': float(turns[finished].std()) if finished.any() else 0.,
+        'turns_percentiles': dict((q, float(np.percentile(turns[finished], q))) for q in (1, 10, 50, 90, 99))
+                             if finished.any() else {},
+        'win_rate': dict((t, float((winners == k).sum() / played)) for k, t in enumerate(Game.TOKENS)),
+        'first_mover_win_rate': float((winners[finished] == first[finished]).sum() / played),
+        'win_types': dict((name, float((win_types == k).sum() / played))
+                          for k, name in [(1, 'single'), (2, 'gammon'), (3, 'backgammon')]),
+        'violations': violations,
+    }
+
+
+def report(summary):
+    print("%d games in %.1fs (%.0f games/sec), %d unfinished" % (
+        summary['games'], summary['seconds'], summary['games_per_sec'], summary['unfinished']))
+    print("Turns: %.1f avg, %.1f std, percentiles %s" % (
+        summary['turns_avg'], summary['turns_std'],
+        ', '.join('p%d %d' % (q, v) for q, v in sorted(summary['turns_percentiles'].items()))))
+    print("Wins: %s, first mover %.2f%%" % (
+        ', '.join('%s %.2f%%' % (t, r * 100.) for t, r in sorted(summary['win_rate'].items())),
+        summary['first_mover_win_rate'] * 100.))
+    print("Outcomes: %s" % ', '.join('%s %.2f%%' % (name, summary['win_types'][name] * 100.)
+                                     for name in ['single', 'gammon', 'backgammon']))
+    for error, (count, example) in sorted(summary['violations'].items()):
+        print("Engine violation %s: %d turns, e.g. %s" % (error, count, example))
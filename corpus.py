@@ -0,0 +1,159 @@
+"""
+Corpus of positions sampled from TD-Gammon self-play.
+
+A corpus is a directory of memory-mappable .npy columns, one row per
+unique position:
+
+    boards.npy   (n, 2, 26) int8, see Game.board_array
+    turns.npy    (n,) int8, index of the player to move
+    hashes.npy   (n,) uint64, hash of board and turn used for deduplication
+    phases.npy   (n,) int8, index in PHASES
+    values.npy   (n,) float32, optional cubeless equity for players[1]
+    phase_<name>.npy  row indices of each phase
+
+plus an index.json describing the columns.
+"""
+from __future__ import division
+
+import os
+import json
+import random
+import hashlib
+
+import numpy as np
+
+from backgammon.game import Game
+from backgammon.agents.td_gammon_agent import TDAgent, equity
+
+PHASES = ['contact', 'race', 'bearoff']
+
+
+def position_hash(board, turn):
+    digest = hashlib.blake2b(board.tobytes() + bytes([turn]), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def phases(boards):
+    """
+    Phase index of each board: race once every piece of players[0] is
+    past every piece of players[1] (players[0] moves up the grid),
+    bearoff once both players are also all home.
+    """
+    points = np.arange(Game.NUMCOLS)
+    on_grid = boards[:, :, :Game.NUMCOLS] > 0
+    on_bar = boards[:, :, Game.NUMCOLS] > 0
+
+    back0 = np.where(on_grid[:, 0], points, Game.NUMCOLS).min(axis=1)
+    back0 = np.where(on_bar[:, 0], -1, back0)
+    back1 = np.where(on_grid[:, 1], points, -1).max(axis=1)
+    back1 = np.where(on_bar[:, 1], Game.NUMCOLS, back1)
+
+    race = back0 > back1
+    home = (back0 >= Game.NUMCOLS - Game.QUAD) & (back1 < Game.QUAD)
+    return np.where(race & home, 2, np.where(race, 1, 0)).astype(np.int8)
+
+
+def sample(model, count, seed=None):
+    """
+    Unique (board, turn) positions seen before each turn of self-play.
+    """
+    rng = random.Random(seed)
+    players = [TDAgent(Game.TOKENS[0], model), TDAgent(Game.TOKENS[1], model)]
+
+    seen = set()
+    boards, turns, hashes = [], [], []
+    while len(boards) < count:
+        game = Game.new(rng=rng)
+        player_num = rng.randint(0, 1)
+        while not game.is_over() and len(boards) < count:
+            board = game.board_array()
+            key = position_hash(board, player_num)
+            if key not in seen:
+                seen.add(key)
+                boards.append(board)
+                turns.append(player_num)
+                hashes.append(key)
+            game.next_step(players[player_num], player_num)
+            player_num = (player_num + 1) % 2
+    return np.array(boards, dtype=np.int8), np.array(turns, dtype=np.int8), np.array(hashes, dtype=np.uint64)
+
+
+def build(model, path, count, seed=None, labels=True, batch_size=4096):
+    """
+    Sample count unique positions and write them as a corpus in path.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    boards, turns, hashes = sample(model, count, seed=seed)
+    columns = {'boards': boards, 'turns': turns, 'hashes': hashes, 'phases': phases(boards)}
+
+    if labels:
+        encoder = getattr(model, 'encoder', None)
+        if encoder is None:
+            from backgammon.features import get_encoder
+            encoder = get_encoder('td198')
+        values = np.empty(len(boards), dtype=np.float32)
+        for start in range(0, len(boards), batch_size):
+            end = start + batch_size
+            features = encoder.encode_batch(boards[start:end], turns[start:end])
+            values[start:end] = equity(model.get_output(features))
+        columns['values'] = values
+
+    for i, name in enumerate(PHASES):
+        columns['phase_%s' % name] = np.flatnonzero(columns['phases'] == i)
+
+    for name, column in columns.items():
+        np.save(os.path.join(path, name + '.npy'), column)
+
+    index = {'positions': len(boards), 'columns': sorted(columns), 'seed': seed,
+             'phases': dict((name, len(columns['phase_%s' % name])) for name in PHASES)}
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    return index
+
+
+class Corpus(object):
+    def __init__(self, path):
+        """
+        Read-only view on a corpus, every column is memory-mapped.
+        """
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        self.columns = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+                            for name in self.index['columns'])
+
+    def __len__(self):
+        return self.index['positions']
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns', {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def rows(self, phase=None):
+        if phase is None:
+            return np.arange(len(self))
+        if phase not in PHASES:
+            raise ValueError('Unknown phase %s, expected one of %s' % (phase, PHASES))
+        return self.columns['phase_%s' % phase]
+
+    def batches(self, batch_size, phase=None, seed=None):
+        """
+        Random minibatches without replacement, as dicts of columns. Rows
+        are read in sorted order within a batch to keep the access local.
+        """
+        rows = np.array(self.rows(phase))
+        np.random.RandomState(seed).shuffle(rows)
+        for start in range(0, len(rows), batch_size):
+            batch = np.sort(rows[start:start + batch_size])
+            yield dict((name, self.columns[name][batch]) for name in ['boards', 'turns', 'phases', 'values']
+                       if name in self.columns)
+
+    def game(self, i):
+        """
+        Game and player to move of row i.
+        """
+        return Game.from_board_array(self.boards[i]), Game.TOKENS[int(self.turns[i])]
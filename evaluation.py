@@ -0,0 +1,242 @@
+"""
+Evaluation helpers shared by the TensorFlow Model and the NumPy Network.
+
+Anything with a get_output(x) method can be passed as model, so these
+functions never need TensorFlow themselves.
+"""
+from __future__ import division
+
+import time
+import random
+
+import numpy as np
+
+from backgammon.game import Game
+from backgammon.agents.human_agent import HumanAgent
+from backgammon.agents.random_agent import RandomAgent
+from backgammon.agents.td_gammon_agent import TDAgent, equity
+from backgammon.agents.anytime_agent import AnytimeAgent
+from metrics import LatencyHistogram
+
+
+def play(model, time_limit=None):
+    game = Game.new()
+    if time_limit:
+        histogram = LatencyHistogram()
+        agent = AnytimeAgent(Game.TOKENS[0], model, time_limit=time_limit, histogram=histogram)
+    else:
+        agent = TDAgent(Game.TOKENS[0], model)
+    game.play([agent, HumanAgent(Game.TOKENS[1])], draw=True)
+    if time_limit:
+        print_latency(histogram, agent.depths)
+
+
+def print_latency(histogram, depths=None):
+    summary = histogram.summary()
+    print("Decision latency over %d decisions: mean %.2f ms, p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+        summary['count'], summary['mean'] * 1e3, summary['p50'] * 1e3, summary['p90'] * 1e3,
+        summary['p99'] * 1e3, summary['max'] * 1e3))
+    if depths:
+        print("Search depth: %s" % ', '.join('%s %d' % (name, count) for name, count in sorted(depths.items())))
+
+
+def test(model, episodes=100, draw=False):
+    # players = [RandomAgent(Game.TOKENS[0]), RandomAgent(Game.TOKENS[1])]
+    players = [TDAgent(Game.TOKENS[0], model), RandomAgent(Game.TOKENS[1])]
+
+    winners = [0, 0]
+    for episode in range(episodes):
+        game = Game.new()
+
+        winner = game.play(players, draw=draw)
+        winners[winner] += 1
+
+        winners_total = sum(winners)
+        print("[Episode %d] %s (%s) vs %s (%s) %d:%d of %d games (%.2f%%)" % (episode, \
+            players[0].name, players[0].player, \
+            players[1].name, players[1].player, \
+            winners[0], winners[1], winners_total, \
+            (winners[0] / winners_total) * 100.0))
+    return winners
+
+
+class CountingModel(object):
+    """
+    Wraps a model and counts the positions it evaluates.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.calls = 0
+        self.positions = 0
+        if hasattr(model, 'evaluate_actions'):
+            self.evaluate_actions = self._evaluate_actions
+
+    # the agents encode positions with the encoder of the wrapped model
+    @property
+    def encoder(self):
+        return getattr(self.model, 'encoder', None)
+
+    @property
+    def layer_sizes(self):
+        return getattr(self.model, 'layer_sizes', None)
+
+    def get_output(self, x):
+        self.calls += 1
+        self.positions += len(x)
+        return self.model.get_output(x)
+
+    def _evaluate_actions(self, game, actions, player):
+        self.calls += 1
+        self.positions += len(actions)
+        return self.model.evaluate_actions(game, actions, player)
+
+
+def benchmark(model, games=10, top_k=None, time_budget=None, time_limit=None):
+    """
+    Time TD-Gammon self-play games and report decision and evaluation
+    throughput. With time_limit, the players are anytime agents and the
+    decision latency is reported too.
+    """
+    counter = CountingModel(model)
+    if time_limit:
+        histogram = LatencyHistogram()
+        players = [AnytimeAgent(Game.TOKENS[0], counter, time_limit=time_limit, histogram=histogram),
+                   AnytimeAgent(Game.TOKENS[1], counter, time_limit=time_limit, histogram=histogram)]
+    else:
+        players = [TDAgent(Game.TOKENS[0], counter, top_k, time_budget),
+                   TDAgent(Game.TOKENS[1], counter, top_k, time_budget)]
+
+    start_ts = time.time()
+    for _ in range(games):
+        Game.new().play(players)
+    elapsed = time.time() - start_ts
+
+    print("%d games in %.2f secs (%.2f games/sec)" % (games, elapsed, games / elapsed))
+    print("%d decisions (%.1f/sec), %d positions (%.1f/sec)" % (counter.calls, counter.calls / elapsed, \
+        counter.positions, counter.positions / elapsed))
+    if time_limit:
+        depths = {}
+        for player in players:
+            for name, count in player.depths.items():
+                depths[name] = depths.get(name, 0) + count
+        print_latency(histogram, depths)
+    return elapsed
+
+
+def sample_positions(model, count=1000, seed=None):
+    """
+    Collect (game, roll, player) decision points from TD-Gammon self-play.
+    """
+    rng = random.Random(seed)
+    players = [TDAgent(Game.TOKENS[0], model), TDAgent(Game.TOKENS[1], model)]
+
+    positions = []
+    while len(positions) < count:
+        game = Game.new()
+        player_num = rng.randint(0, 1)
+        while not game.is_over() and len(positions) < count:
+            roll = (rng.randint(1, game.die), rng.randint(1, game.die))
+            positions.append((game.clone(), roll, players[player_num].player))
+            game.take_turn(players[player_num], roll)
+            player_num = (player_num + 1) % 2
+    return positions
+
+
+def corpus_positions(path, count=None, seed=None):
+    """
+    (game, roll, player) decision points from the positions of a corpus,
+    count rows drawn at random (all of them by default), each with a
+    random roll.
+    """
+    import corpus
+    positions = corpus.Corpus(path)
+    state = np.random.RandomState(seed)
+    rows = np.arange(len(positions))
+    if count is not None and count < len(rows):
+        rows = np.sort(state.choice(rows, count, replace=False))
+
+    decisions = []
+    for i in rows:
+        game, player = positions.game(i)
+        roll = tuple(int(r) for r in state.randint(1, game.die + 1, size=2))
+        decisions.append((game, roll, player))
+    return decisions
+
+
+def agreement(reference, candidate, positions):
+    """
+    Compare the move choices and afterstate equities of two models over a
+    list of positions from sample_positions or corpus_positions. Positions with a single legal
+    move are skipped.
+    """
+    decisions = agreed = 0
+    max_error = 0.
+    errors = []
+    times = [0., 0.]
+    for game, roll, player in positions:
+        actions = list(game.get_actions_doubles(roll, player, nodups=True))
+        if len(actions) < 2:
+            continue
+
+        # equities for the player to move, the ones TDAgent picks its move
+        # from
+        values = []
+        for i, model in enumerate([reference, candidate]):
+            start_ts = time.time()
+            values.append(TDAgent(player, model).values(game, actions, player))
+            times[i] += time.time() - start_ts
+        decisions += 1
+        agreed += int(np.argmax(values[0]) == np.argmax(values[1]))
+        error = np.abs(values[0] - values[1])
+        errors.append(error.mean())
+        max_error = max(max_error, float(error.max()))
+
+    decisions = max(decisions, 1)
+    print("Move agreement: %d/%d (%.2f%%)" % (agreed, decisions, agreed / decisions * 100.0))
+    print("Equity error: mean %.6f, max %.6f" % (float(np.mean(errors)) if errors else 0., max_error))
+    print("Evaluation time: reference %.3f secs, candidate %.3f secs" % tuple(times))
+    return agreed / decisions
+
+
+def pruning_agreement(model, positions, top_k=None, time_budget=None):
+    """
+    Compare the moves of TDAgent with the prefilter (top_k, time_budget)
+    and with full evaluation over positions from sample_positions. Also
+    reports the equity lost by the pruned choices and the worst decision
+    time of both.
+    """
+    decisions = agreed = 0
+    evaluated = 0
+    losses = []
+    times = [[], []]
+    full_agent = TDAgent(Game.TOKENS[0], model)
+    pruned_agent = TDAgent(Game.TOKENS[0], model, top_k, time_budget)
+    for game, roll, player in positions:
+        actions = list(game.get_actions_doubles(roll, player, nodups=True))
+        if len(actions) < 2:
+            continue
+
+        features = game.afterstate_features(actions, player, getattr(model, 'encoder', None))
+        values = equity(model.get_output(features))
+        values = -values if player == game.players[0] else values
+
+        choices = []
+        for i, agent in enumerate([full_agent, pruned_agent]):
+            agent.player = player
+            start_ts = time.time()
+            choices.append(actions.index(agent.get_action(actions, game)))
+            times[i].append(time.time() - start_ts)
+        evaluated += len(pruned_agent.candidates(actions, game)[0])
+
+        decisions += 1
+        agreed += int(choices[0] == choices[1])
+        losses.append(values[choices[0]] - values[choices[1]])
+
+    decisions = max(decisions, 1)
+    print("Move agreement: %d/%d (%.2f%%)" % (agreed, decisions, agreed / decisions * 100.0))
+    print("Equity loss: mean %.6f, max %.6f" % (float(np.mean(losses)) if losses else 0., max(losses or [0.])))
+    print("Moves evaluated: %.1f per decision" % (evaluated / decisions))
+    for name, t in zip(['full', 'pruned'], times):
+        if t:
+            print("Decision time %s: mean %.2f ms, max %.2f ms" % (name, np.mean(t) * 1e3, np.max(t) * 1e3))
+    return agreed / decisions
@@ -0,0 +1,250 @@
+"""
+Differential fuzzing of the move generator.
+
+Random reachable positions come from batched random play (see
+backgammon.simulator), each with a random roll. The moves of the Game
+engine are compared with an independent reference generator working on
+count arrays: both are reduced to the set of positions they reach, so
+the order of the steps and duplicate moves do not matter. Every
+divergence is shrunk, by removing pieces while the positions still
+diverge the same way, into a minimal repro.
+
+The reference follows the rules of get_actions_doubles: pieces on the
+bar enter first, as many dice as possible are played, and with two
+different dice either one may be played when only one can.
+"""
+from __future__ import division
+
+import io
+import json
+import time
+import multiprocessing
+
+import numpy as np
+
+from backgammon.game import Game
+from backgammon.simulator import (BAR, OFF, START, flip, physical, play_turn, legal_steps, apply_step,
+                                  undo_step)
+
+ENGINES = {
+    'doubles': lambda game: game.get_actions_doubles,
+    'legacy': lambda game: game.get_actions,
+}
+
+
+def reference_afterstates(own, opp, roll):
+    """
+    Positions (own, opp) reachable from a board seen by the player to move
+    (lists of counts, see backgammon.simulator) with roll.
+    """
+    d1, d2 = roll
+    orders = [(d1,) * 4] if d1 == d2 else [(d1, d2), (d2, d1)]
+    reached = {}
+    visited = set()
+
+    def search(dice, played):
+        # different step orders often reach the same position
+        key = (len(dice), tuple(own), tuple(opp))
+        if key in visited:
+            return
+        visited.add(key)
+        steps = legal_steps(own, opp, dice[0]) if dice else []
+        if not steps:
+            reached.setdefault(played, set()).add((tuple(own), tuple(opp)))
+            return
+        for s in steps:
+            hit = apply_step(own, opp, s)
+            search(dice[1:], played + 1)
+            undo_step(own, opp, s, hit)
+
+    for dice in orders:
+        visited.clear()
+        search(dice, 0)
+    played = max(reached)
+    # no move at all when no die can be played
+    return reached[played] if played else set()
+
+
+def engine_afterstates(own, opp, mover, roll, engine='doubles'):
+    """
+    Positions reached by the moves of the Game engine, in the same form as
+    reference_afterstates, and the moves that leave the board. The steps
+    are replayed on the count lists, which is much faster than taking the
+    actions on the game.
+    """
+    token = Game.TOKENS[mover]
+    game = Game.from_board_array(physical(np.array(own), np.array(opp), mover))
+
+    def point(i):
+        return i if mover == 0 else Game.NUMCOLS - 1 - i
+
+    reached, invalid = set(), []
+    for action in ENGINES[engine](game)(roll, token, nodups=True):
+        if any(s != Game.ON and not 0 <= s < Game.NUMCOLS or e != Game.OFF and not 0 <= e < Game.NUMCOLS
+               for s, e in action):
+            invalid.append(action)
+            continue
+        after_own, after_opp = list(own), list(opp)
+        for s, e in action:
+            apply_step(after_own, after_opp, (BAR if s == Game.ON else point(s), OFF if e == Game.OFF else point(e)))
+        reached.add((tuple(after_own), tuple(after_opp)))
+    return reached, invalid
+
+
+def compare(own, opp, mover, roll, engine='doubles'):
+    """
+    Kinds of divergence of the engine on one position: 'invalid' (moves
+    leaving the board), 'extra' (positions the reference cannot reach) and
+    'missing' (positions the engine does not reach), with an example each.
+    """
+    own, opp = [int(v) for v in own], [int(v) for v in opp]
+    try:
+        reached, invalid = engine_afterstates(own, opp, mover, roll, engine)
+    except Exception as e:
+        return {'error': repr(e)}
+    expected = reference_afterstates(own, opp, roll)
+
+    divergences = {}
+    if invalid:
+        divergences['invalid'] = str(invalid[0])
+    if reached - expected:
+        divergences['extra'] = min(reached - expected)
+    if expected - reached:
+        divergences['missing'] = min(expected - reached)
+    return divergences
+
+
+def shrink(own, opp, mover, roll, kind, engine='doubles'):
+    """
+    Remove pieces one at a time as long as the engine still diverges with
+    the same kind, returns the smallest board found.
+    """
+    own, opp = [int(v) for v in own], [int(v) for v in opp]
+    progress = True
+    while progress:
+        progress = False
+        for board in (own, opp):
+            for i in range(len(board)):
+                if not board[i]:
+                    continue
+                board[i] -= 1
+                if kind in compare(own, opp, mover, roll, engine):
+                    progress = True
+                else:
+                    board[i] += 1
+    return own, opp
+
+
+def repro(own, opp, mover, roll, engine='doubles'):
+    """
+    Description of a divergence, with the board as drawn by the game.
+    """
+    board = physical(np.array(own), np.array(opp), mover)
+    out = io.StringIO()
+    Game.from_board_array(board).draw(out=out)
+    return {
+        'board': board.tolist(),
+        'player': Game.TOKENS[mover],
+        'roll': [int(roll[0]), int(roll[1])],
+        'engine': engine,
+        'divergences': dict((k, str(v)) for k, v in compare(own, opp, mover, roll, engine).items()),
+        'drawing': out.getvalue(),
+    }
+
+
+def positions(count, seed=None, batch_size=256):
+    """
+    count random (own, opp, mover) positions from batched random play,
+    before the move of mover.
+    """
+    rng = np.random.RandomState(seed)
+    # the starting position is the same from both sides
+    own = np.tile(START[0], (batch_size, 1)).astype(np.int64)
+    opp = np.tile(START[1], (batch_size, 1)).astype(np.int64)
+    mover = rng.randint(0, 2, batch_size)
+
+    produced = 0
+    while produced < count:
+        for i in range(min(batch_size, count - produced)):
+            yield own[i], opp[i], int(mover[i])
+        produced += batch_size
+
+        play_turn(own, opp, rng)
+        done = own[:, OFF] == START[0].sum()
+        own, opp, mover = flip(opp), flip(own), 1 - mover
+        # restart the finished games
+        own[done], opp[done] = START[0], START[1]
+
+
+def fuzz_batch(count, seed=None, engine='doubles', max_repros=3):
+    """
+    Compare the engine and the reference on count positions, returns the
+    number of positions of each kind of divergence and a few shrunk
+    repros per kind.
+    """
+    rng = np.random.RandomState(seed)
+    counts, repros = {}, {}
+    for own, opp, mover in positions(count, seed):
+        roll = (rng.randint(1, Game.QUAD + 1), rng.randint(1, Game.QUAD + 1))
+        for kind in compare(own, opp, mover, roll, engine):
+            counts[kind] = counts.get(kind, 0) + 1
+            if len(repros.setdefault(kind, [])) < max_repros:
+                small_own, small_opp = shrink(own, opp, mover, roll, kind, engine)
+                repros[kind].append(repro(small_own, small_opp, mover, roll, engine))
+    return counts, repros
+
+
+def _run_batch(task):
+    return fuzz_batch(*task)
+
+
+def fuzz(count, workers=None, seed=0, batch_size=10000, engine='doubles', max_repros=3):
+    """
+    Fuzz count positions in batches across workers processes.
+    """
+    rng = np.random.RandomState(seed)
+    tasks = [(min(batch_size, count - start), rng.randint(2 ** 31), engine, max_repros)
+             for start in range(0, count, batch_size)]
+
+    start_ts = time.time()
+    if workers == 1:
+        batches = [_run_batch(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            batches = pool.map(_run_batch, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start_ts
+
+    counts, repros = {}, {}
+    for batch_counts, batch_repros in batches:
+        for kind, n in batch_counts.items():
+            counts[kind] = counts.get(kind, 0) + n
+        for kind, found in batch_repros.items():
+            repros.setdefault(kind, []).extend(found)
+    # smallest repros first
+    for kind in repros:
+        repros[kind].sort(key=lambda r: np.sum(r['board']))
+        repros[kind] = repros[kind][:max_repros]
+
+    return {'positions': count, 'seconds': elapsed, 'positions_per_sec': count / max(elapsed, 1e-9),
+            'engine': engine, 'divergences': counts, 'repros': repros}
+
+
+def report(summary, path=None):
+    print("%d positions in %.1fs (%.0f positions/sec) on %s" % (
+        summary['positions'], summary['seconds'], summary['positions_per_sec'], summary['engine']))
+    if not summary['divergences']:
+        print("No divergence")
+    for kind, count in sorted(summary['divergences'].items()):
+        print("%s: %d positions (%.3f%%)" % (kind, count, count / summary['positions'] * 100.))
+        for r in summary['repros'][kind][:1]:
+            print("Player %s rolled <%d, %d>, %s" % (r['player'], r['roll'][0], r['roll'][1], r['divergences']))
+            print(r['drawing'])
+    if path:
+        with open(path, 'w') as f:
+            for kind in sorted(summary['repros']):
+                for r in summary['repros'][kind]:
+                    f.write(json.dumps(dict(r, kind=kind), sort_keys=True) + '\n')
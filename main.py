@@ -1,37 +1,474 @@
-import os
-import tensorflow.compat.v1 as tf
-tf.disable_v2_behavior()
+"""
+Command line entry point.
 
-from model import Model
+    python main.py train [--restore] [--resume] [--seed N] [--backend tensorflow|numpy] [--weights FILE]
+                         [--encoder td198|td294|extended] [--hidden 80 ...] [--outputs 1-5]
+    python main.py test [--weights FILE] [--episodes N]
+    python main.py play [--weights FILE] [--time-limit SECS]
+    python main.py benchmark [--weights FILE] [--games N] [--top-k K] [--time-budget SECS] [--time-limit SECS]
+    python main.py export [--output FILE] [--dtype float32|float16|bfloat16|int8]
+    python main.py accuracy --weights FILE (--candidate FILE | --dtype DTYPE) [--corpus DIR]
+    python main.py pruning [--weights FILE] [--top-k K] [--time-budget SECS]
+    python main.py tournament [--pool DIR] [--mode round-robin|gauntlet] [--challenger FILE]
+    python main.py serve [--weights FILE] [--socket PATH]
+    python main.py sessions (--weights FILE | --server PATH) [--port PORT] [--time-limit SECS]
+    python main.py corpus [--weights FILE] [--positions N] [--output DIR]
+    python main.py match [--weights FILE] [--length N] [--matches N]
+    python main.py simulate [--games N] [--workers N] [--check RATE]
+    python main.py fuzz [--positions N] [--workers N] [--engine doubles|legacy] [--repros FILE]
+    python main.py gradcheck [--encoder NAME] [--hidden 80 ...] [--outputs 1-5]
+    python main.py analyze [--weights FILE] (--ids FILE | --corpus DIR) [--output FILE] [--format jsonl|csv]
+                           [--all-rolls] [--all-moves] [--batch-size N] [--workers N]
 
-flags = tf.app.flags
-FLAGS = flags.FLAGS
+The former flags still work and print the equivalent command: --test is
+test --episodes 1000, --play is play and --restore is train --restore.
 
-flags.DEFINE_boolean('test', False, 'If true, test against a random strategy.')
-flags.DEFINE_boolean('play', False, 'If true, play against a trained TD-Gammon strategy.')
-flags.DEFINE_boolean('restore', False, 'If true, restore a checkpoint before training.')
+TensorFlow is only imported by the commands that need the training graph.
+The TensorFlow backend saves its network config next to the checkpoints,
+so commands restoring a checkpoint rebuild the architecture it was
+trained with. test, play and benchmark run on the NumPy network when
+--weights is given,
+optionally with the incremental move evaluator (--incremental), or on a
+running inference server with --server.
+"""
+import os
+import argparse
+import contextlib
 
 model_path = os.environ.get('MODEL_PATH', 'models/')
 summary_path = os.environ.get('SUMMARY_PATH', 'summaries/')
 checkpoint_path = os.environ.get('CHECKPOINT_PATH', 'checkpoints/')
 
-if not os.path.exists(model_path):
-    os.makedirs(model_path)
 
-if not os.path.exists(checkpoint_path):
-    os.makedirs(checkpoint_path)
+@contextlib.contextmanager
+def tf_model(restore=False, config=None):
+    """
+    Build the TensorFlow training graph and yield the Model inside its
+    graph and session.
+    """
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
 
-if not os.path.exists(summary_path):
-    os.makedirs(summary_path)
+    from model import Model
 
-if __name__ == '__main__':
     graph = tf.Graph()
     sess = tf.Session(graph=graph)
     with sess.as_default(), graph.as_default():
-        model = Model(sess, model_path, summary_path, checkpoint_path, restore=FLAGS.restore)
-        if FLAGS.test:
-            model.test(episodes=1000)
-        elif FLAGS.play:
-            model.play()
+        yield Model(sess, model_path, summary_path, checkpoint_path, restore=restore, config=config)
+
+
+@contextlib.contextmanager
+def inference_model(weights, incremental=False, server='', shared=''):
+    """
+    Yield a client of the inference server, a subscriber of the weights
+    published in shared memory, the NumPy network stored in weights, or
+    fall back to the restored TensorFlow model.
+    """
+    if shared:
+        from shared_weights import WeightSubscriber
+        subscriber = WeightSubscriber(shared)
+        try:
+            yield subscriber
+        finally:
+            subscriber.close()
+    elif server:
+        from server import InferenceClient
+        client = InferenceClient(server)
+        try:
+            yield client
+        finally:
+            client.close()
+    elif weights:
+        from network import Network, IncrementalEvaluator
+        network = Network.load(weights)
+        yield IncrementalEvaluator(network) if incremental else network
+    else:
+        with tf_model(restore=True) as model:
+            yield model
+
+
+def train(args):
+    # architecture flags left out come from the restored checkpoint, or
+    # the defaults of network.DEFAULT_CONFIG
+    config = dict((name, getattr(args, name)) for name in ['encoder', 'hidden', 'outputs']
+                  if getattr(args, name) is not None)
+    if args.backend == 'numpy':
+        import trainer
+        from network import Network, DEFAULT_CONFIG, layer_sizes
+        from optimizer import TDLambda
+
+        if args.weights:
+            optimizer = TDLambda.from_network(Network.load(args.weights, mmap=False))
         else:
-            model.train()
+            config = dict(DEFAULT_CONFIG, **config)
+            optimizer = TDLambda(layer_sizes(config), encoder=config['encoder'])
+
+        publisher = None
+        if args.publish:
+            from shared_weights import WeightPublisher
+            publisher = WeightPublisher.from_network(optimizer.network, name=args.publish)
+            print('Publishing weights to shared memory %s' % publisher.name)
+        try:
+            trainer.train(optimizer, model_path, summary_path, os.path.join(checkpoint_path, 'run_state'),
+                          resume=args.resume, seed=args.seed, publisher=publisher)
+        finally:
+            if publisher is not None:
+                publisher.close()
+                publisher.unlink()
+        return
+
+    with tf_model(restore=args.restore, config=config) as model:
+        model.train(resume=args.resume, seed=args.seed)
+
+
+def test(args):
+    import evaluation
+    with inference_model(args.weights, args.incremental, args.server, args.shared) as model:
+        evaluation.test(model, episodes=args.episodes)
+
+
+def play(args):
+    import evaluation
+    with inference_model(args.weights, args.incremental, args.server, args.shared) as model:
+        evaluation.play(model, time_limit=args.time_limit)
+
+
+def benchmark(args):
+    import evaluation
+    with inference_model(args.weights, args.incremental, args.server, args.shared) as model:
+        evaluation.benchmark(model, games=args.games, top_k=args.top_k, time_budget=args.time_budget,
+                             time_limit=args.time_limit)
+
+
+def export(args):
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with tf_model(restore=True) as model:
+        model.export(args.output, dtype=args.dtype)
+
+
+def accuracy(args):
+    import evaluation
+    from network import Network
+
+    with inference_model(args.weights) as reference:
+        if args.candidate:
+            candidate = Network.load(args.candidate)
+        else:
+            if not isinstance(reference, Network):
+                raise SystemExit('--dtype needs --weights, use --candidate with a checkpoint')
+            candidate = reference.quantize(args.dtype)
+        if args.corpus:
+            positions = evaluation.corpus_positions(args.corpus, count=args.positions, seed=args.seed)
+        else:
+            positions = evaluation.sample_positions(reference, count=args.positions, seed=args.seed)
+        evaluation.agreement(reference, candidate, positions)
+
+
+def pruning(args):
+    import evaluation
+    with inference_model(args.weights) as model:
+        positions = evaluation.sample_positions(model, count=args.positions, seed=args.seed)
+        evaluation.pruning_agreement(model, positions, top_k=args.top_k, time_budget=args.time_budget)
+
+
+def serve(args):
+    from server import InferenceServer
+    with inference_model(args.weights) as model:
+        server = InferenceServer(args.socket, model, max_batch=args.max_batch,
+                                 max_delay=args.max_delay_ms / 1000.)
+        print('Serving on %s' % args.socket)
+        server.serve()
+
+
+def sessions(args):
+    from sessions import SessionManager
+    if not args.weights and not args.server:
+        raise SystemExit('sessions needs --weights or --server')
+    manager = SessionManager(weights=args.weights, server=args.server, workers=args.workers,
+                             processes=args.processes, pace=args.pace, time_limit=args.time_limit)
+    manager.run(args.host, args.port)
+
+
+def build_corpus(args):
+    import corpus
+    with inference_model(args.weights) as model:
+        index = corpus.build(model, args.output, args.positions, seed=args.seed, labels=not args.no_labels)
+    print('%d positions written to %s (%s)' % (index['positions'], args.output, ', '.join(
+        '%s %d' % (name, index['phases'][name]) for name in corpus.PHASES)))
+
+
+def match(args):
+    import random
+    from backgammon.game import Game
+    from backgammon.cube import CubefulEvaluator, play_match
+    from backgammon.agents.td_gammon_agent import TDAgent
+
+    rng = random.Random(args.seed)
+    wins = dict((t, 0) for t in Game.TOKENS)
+    with inference_model(args.weights) as model:
+        evaluator = CubefulEvaluator(model)
+        players = [TDAgent(Game.TOKENS[0], model), TDAgent(Game.TOKENS[1], model)]
+        for i in range(args.matches):
+            score, games = play_match(players, args.length, evaluator, rng=rng)
+            winner = max(score, key=score.get)
+            wins[winner] += 1
+            print('[Match %d] %s wins %d-%d in %d games (max cube %d)' % (
+                i, winner, score[winner], min(score.values()), len(games), max(g.cube_value for g in games)))
+    print('%s %d, %s %d' % (Game.TOKENS[0], wins[Game.TOKENS[0]], Game.TOKENS[1], wins[Game.TOKENS[1]]))
+
+
+def simulate(args):
+    from backgammon.simulator import simulate, report
+    report(simulate(args.games, workers=args.workers, seed=args.seed, batch_size=args.batch_size, check=args.check))
+
+
+def fuzz(args):
+    from fuzz import fuzz, report
+    summary = fuzz(args.positions, workers=args.workers, seed=args.seed, batch_size=args.batch_size,
+                   engine=args.engine)
+    report(summary, args.repros)
+    if summary['divergences']:
+        raise SystemExit(1)
+
+
+def analyze(args):
+    import sys
+    import time
+    import analysis
+    if bool(args.ids) == bool(args.corpus):
+        raise SystemExit('analyze needs one of --ids or --corpus')
+    positions = analysis.read_position_ids(args.ids) if args.ids else analysis.read_corpus(args.corpus)
+
+    with inference_model(args.weights) as model:
+        start_ts = time.time()
+        rows = analysis.analyze(model, positions, batch_size=args.batch_size, workers=args.workers,
+                                all_rolls=args.all_rolls, all_moves=args.all_moves)
+        try:
+            if args.output == '-':
+                count = analysis.write(rows, sys.stdout, args.format)
+            else:
+                with open(args.output, 'w', newline='') as out:
+                    count = analysis.write(rows, out, args.format)
+        except ValueError as e:
+            # a malformed line of the input
+            raise SystemExit(str(e))
+        elapsed = time.time() - start_ts
+    # the results may be on stdout
+    sys.stderr.write('%d rows in %.1fs (%.0f rows/sec)\n' % (count, elapsed, count / max(elapsed, 1e-9)))
+
+
+def gradcheck(args):
+    from network import layer_sizes
+    from optimizer import check_gradients
+    sizes = layer_sizes({'encoder': args.encoder, 'hidden': args.hidden, 'outputs': args.outputs})
+    check_gradients(sizes, seed=args.seed)
+    print('TD(lambda) gradients and per-output traces of %s are consistent' % sizes)
+
+
+def tournament(args):
+    from tournament import Tournament, load_pool, schedule
+
+    pool = load_pool(args.pool)
+    if args.challenger and args.challenger not in pool:
+        pool.append(args.challenger)
+    pairings = schedule(pool, mode=args.mode, challenger=args.challenger or None)
+
+    results = Tournament(args.results)
+    if pairings:
+        results.run(pairings, pairs=args.pairs, workers=args.workers, seed=args.seed)
+    results.print_ratings()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='TD-Gammon')
+    commands = parser.add_subparsers(dest='command')
+
+    cmd = commands.add_parser('train', help='Train the network by self-play.')
+    cmd.add_argument('--restore', action='store_true', help='Restore a checkpoint before training.')
+    cmd.add_argument('--resume', action='store_true', help='Resume from the latest run state, with counters and random state.')
+    cmd.add_argument('--seed', type=int, default=None, help='Seed of the dice.')
+    cmd.add_argument('--backend', default='tensorflow', choices=['tensorflow', 'numpy'])
+    cmd.add_argument('--weights', default='', help='Network file to start the numpy backend from.')
+    cmd.add_argument('--encoder', default=None, choices=['td198', 'td294', 'extended'],
+                     help='Input encoder, td198 by default or the one of the restored checkpoint.')
+    cmd.add_argument('--hidden', type=int, nargs='+', default=None,
+                     help='Sizes of the hidden layers, 80 by default or the ones of the restored checkpoint.')
+    cmd.add_argument('--outputs', type=int, default=None, choices=range(1, 6),
+                     help='Network outputs: win, win gammon, win backgammon, lose gammon, lose backgammon. '
+                          '1 by default or the ones of the restored checkpoint.')
+    cmd.add_argument('--publish', default='', help='Publish the weights of the numpy backend to this shared memory block.')
+    cmd.set_defaults(func=train)
+
+    cmd = commands.add_parser('test', help='Test against a random strategy.')
+    cmd.add_argument('--weights', default='', help='Network file to use instead of the latest checkpoint.')
+    cmd.add_argument('--episodes', type=int, default=1000)
+    cmd.add_argument('--incremental', action='store_true', help='Evaluate moves incrementally from the board cells they change.')
+    cmd.add_argument('--server', default='', help='Socket of a running inference server.')
+    cmd.add_argument('--shared', default='', help='Shared memory block of a training run publishing its weights.')
+    cmd.set_defaults(func=test)
+
+    cmd = commands.add_parser('play', help='Play against a trained TD-Gammon strategy.')
+    cmd.add_argument('--weights', default='', help='Network file to use instead of the latest checkpoint.')
+    cmd.add_argument('--incremental', action='store_true', help='Evaluate moves incrementally from the board cells they change.')
+    cmd.add_argument('--server', default='', help='Socket of a running inference server.')
+    cmd.add_argument('--shared', default='', help='Shared memory block of a training run publishing its weights.')
+    cmd.add_argument('--time-limit', type=float, default=None, help='Seconds per move of the anytime search.')
+    cmd.set_defaults(func=play)
+
+    cmd = commands.add_parser('benchmark', help='Measure self-play throughput.')
+    cmd.add_argument('--weights', default='', help='Network file to use instead of the latest checkpoint.')
+    cmd.add_argument('--games', type=int, default=10)
+    cmd.add_argument('--top-k', type=int, default=None, help='Evaluate only the best moves of the prefilter.')
+    cmd.add_argument('--time-budget', type=float, default=None, help='Seconds per move, bounds the moves evaluated.')
+    cmd.add_argument('--incremental', action='store_true', help='Evaluate moves incrementally from the board cells they change.')
+    cmd.add_argument('--server', default='', help='Socket of a running inference server.')
+    cmd.add_argument('--shared', default='', help='Shared memory block of a training run publishing its weights.')
+    cmd.add_argument('--time-limit', type=float, default=None, help='Seconds per move of the anytime search.')
+    cmd.set_defaults(func=benchmark)
+
+    cmd = commands.add_parser('export', help='Export the latest checkpoint to a network file.')
+    cmd.add_argument('--output', default=os.path.join(model_path, 'td_gammon.tdg'))
+    cmd.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'bfloat16', 'int8'])
+    cmd.set_defaults(func=export)
+
+    cmd = commands.add_parser('accuracy', help='Compare the move choices of a reduced precision network with the reference.')
+    cmd.add_argument('--weights', default='', help='Reference network file, defaults to the latest checkpoint.')
+    cmd.add_argument('--candidate', default='', help='Network file to compare with the reference.')
+    cmd.add_argument('--dtype', default='int8', choices=['float16', 'bfloat16', 'int8'],
+                     help='Quantize the reference in memory when no candidate is given.')
+    cmd.add_argument('--corpus', default='', help='Corpus directory to draw the positions from instead of self-play.')
+    cmd.add_argument('--positions', type=int, default=1000)
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.set_defaults(func=accuracy)
+
+    cmd = commands.add_parser('pruning', help='Compare the moves chosen with the prefilter with full evaluation.')
+    cmd.add_argument('--weights', default='', help='Network file to use instead of the latest checkpoint.')
+    cmd.add_argument('--top-k', type=int, default=8)
+    cmd.add_argument('--time-budget', type=float, default=None, help='Seconds per move.')
+    cmd.add_argument('--positions', type=int, default=1000)
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.set_defaults(func=pruning)
+
+    cmd = commands.add_parser('tournament', help='Play exported snapshots against each other and rate them.')
+    cmd.add_argument('--pool', default=os.path.join(model_path, 'snapshots'))
+    cmd.add_argument('--mode', default='round-robin', choices=['round-robin', 'gauntlet'])
+    cmd.add_argument('--challenger', default='', help='Network file playing the gauntlet.')
+    cmd.add_argument('--pairs', type=int, default=50, help='Mirrored game pairs per pairing.')
+    cmd.add_argument('--workers', type=int, default=None)
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.add_argument('--results', default=os.path.join(model_path, 'tournament.json'))
+    cmd.set_defaults(func=tournament)
+
+    cmd = commands.add_parser('serve', help='Serve batched network evaluations over a Unix socket.')
+    cmd.add_argument('--weights', default='', help='Network file to use instead of the latest checkpoint.')
+    cmd.add_argument('--socket', default='/tmp/td_gammon.sock')
+    cmd.add_argument('--max-batch', type=int, default=512)
+    cmd.add_argument('--max-delay-ms', type=float, default=2.)
+    cmd.set_defaults(func=serve)
+
+    cmd = commands.add_parser('sessions', help='Host concurrent human vs TD-Gammon games on a local socket.')
+    cmd.add_argument('--weights', default='', help='Network file used by the bots.')
+    cmd.add_argument('--server', default='', help='Socket of a running inference server used by the bots.')
+    cmd.add_argument('--host', default='127.0.0.1')
+    cmd.add_argument('--port', type=int, default=8765)
+    cmd.add_argument('--workers', type=int, default=4)
+    cmd.add_argument('--processes', action='store_true', help='Compute bot moves in processes instead of threads.')
+    cmd.add_argument('--pace', type=float, default=0.5, help='Pause between turns in seconds.')
+    cmd.add_argument('--time-limit', type=float, default=None, help='Seconds per bot move of the anytime search.')
+    cmd.set_defaults(func=sessions)
+
+    cmd = commands.add_parser('corpus', help='Build a deduplicated corpus of self-play positions.')
+    cmd.add_argument('--weights', default='', help='Network file to use instead of the latest checkpoint.')
+    cmd.add_argument('--positions', type=int, default=100000)
+    cmd.add_argument('--output', default='corpus/')
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.add_argument('--no-labels', action='store_true', help='Do not store the network equity of the positions.')
+    cmd.set_defaults(func=build_corpus)
+
+    cmd = commands.add_parser('match', help='Play TD-Gammon matches against itself with the doubling cube.')
+    cmd.add_argument('--weights', default='', help='Network file to use instead of the latest checkpoint.')
+    cmd.add_argument('--length', type=int, default=7, help='Match length in points, 0 for a money game.')
+    cmd.add_argument('--matches', type=int, default=10)
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.set_defaults(func=match)
+
+    cmd = commands.add_parser('simulate', help='Play fast random games and report their lengths and outcomes.')
+    cmd.add_argument('--games', type=int, default=100000)
+    cmd.add_argument('--workers', type=int, default=None)
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.add_argument('--batch-size', type=int, default=1000)
+    cmd.add_argument('--check', type=float, default=0., help='Fraction of the turns replayed and checked on the Game engine.')
+    cmd.set_defaults(func=simulate)
+
+    cmd = commands.add_parser('fuzz', help='Compare the legal moves of the engine with a reference generator.')
+    cmd.add_argument('--positions', type=int, default=100000)
+    cmd.add_argument('--workers', type=int, default=None)
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.add_argument('--batch-size', type=int, default=10000)
+    cmd.add_argument('--engine', default='doubles', choices=['doubles', 'legacy'],
+                     help='get_actions_doubles or the legacy get_actions.')
+    cmd.add_argument('--repros', default='', help='Write the minimal repros to this json lines file.')
+    cmd.set_defaults(func=fuzz)
+
+    cmd = commands.add_parser('gradcheck', help='Check the gradients and traces of the NumPy TD(lambda) optimizer.')
+    cmd.add_argument('--encoder', default='td198', choices=['td198', 'td294', 'extended'])
+    cmd.add_argument('--hidden', type=int, nargs='+', default=[80], help='Sizes of the hidden layers.')
+    cmd.add_argument('--outputs', type=int, default=5, choices=range(1, 6))
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.set_defaults(func=gradcheck)
+
+    cmd = commands.add_parser('analyze', help='Equities and best moves of positions in bulk.')
+    cmd.add_argument('--weights', default='', help='Network file to use instead of the latest checkpoint.')
+    cmd.add_argument('--ids', default='', help='File of position IDs, one per line with the player and roll.')
+    cmd.add_argument('--corpus', default='', help='Corpus directory.')
+    cmd.add_argument('--output', default='-', help='Output file, - for stdout.')
+    cmd.add_argument('--format', default='jsonl', choices=['jsonl', 'csv'])
+    cmd.add_argument('--all-rolls', action='store_true', help='Best move for each of the 21 rolls of positions without a roll.')
+    cmd.add_argument('--all-moves', action='store_true', help='List every move with its equity (jsonl only).')
+    cmd.add_argument('--batch-size', type=int, default=4096)
+    cmd.add_argument('--workers', type=int, default=None)
+    cmd.set_defaults(func=analyze)
+
+    return parser
+
+
+LEGACY_FLAGS = ['test', 'play', 'restore']
+
+
+def legacy_argv(argv):
+    """
+    Subcommand arguments for the boolean flags of the former command
+    line (--test, --play, --restore, also as --flag=true or --noflag),
+    or None when argv does not use them.
+    """
+    flags = {}
+    for arg in argv:
+        name, _, value = arg.lstrip('-').partition('=')
+        enabled = value.lower() not in ('false', '0', 'no') if value else True
+        if name.startswith('no') and name[2:] in LEGACY_FLAGS and not value:
+            name, enabled = name[2:], False
+        if not arg.startswith('--') or name not in LEGACY_FLAGS:
+            return None
+        flags[name] = enabled
+
+    if flags.get('test'):
+        return ['test', '--episodes', '1000']
+    if flags.get('play'):
+        return ['play']
+    return ['train', '--restore'] if flags.get('restore') else ['train']
+
+
+if __name__ == '__main__':
+    import sys
+    parser = build_parser()
+    argv = legacy_argv(sys.argv[1:]) if sys.argv[1:] else None
+    if argv is not None:
+        sys.stderr.write('The --test/--play/--restore flags are deprecated, running: python main.py %s\n'
+                         % ' '.join(argv))
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # keep `python main.py` training like before
+        args = parser.parse_args(['train'])
+    args.func(args)
@@ -0,0 +1,158 @@
+"""
+Training metrics aggregated in Python over windows of games, and written
+by a background thread so the training loop never waits on disk.
+"""
+from __future__ import division
+
+import json
+import time
+import queue
+import threading
+import traceback
+
+import numpy as np
+
+from backgammon.game import Game
+
+
+class GameMetrics(object):
+    def __init__(self, window=100):
+        """
+        Collects steps and games and summarizes them every window games.
+        """
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.start_ts = time.time()
+        self.games = 0
+        self.turns = 0
+        self.wins = [0, 0]
+        self.steps = 0
+        self.delta_sum = 0.
+        self.loss_sum = 0.
+
+    def add_step(self, delta, loss):
+        self.steps += 1
+        self.delta_sum += delta
+        self.loss_sum += loss
+
+    def add_game(self, turns, winner):
+        self.games += 1
+        self.turns += turns
+        self.wins[winner] += 1
+
+    def state(self):
+        """
+        Accumulators of the current window, for run states.
+        """
+        return dict((k, v) for k, v in self.__dict__.items() if k not in ('window', 'start_ts'))
+
+    def load_state(self, state):
+        self.__dict__.update(state)
+        self.start_ts = time.time()
+
+    def ready(self):
+        return self.games >= self.window
+
+    def flush(self):
+        """
+        Scalars of the current window, then start a new one.
+        """
+        games = max(self.games, 1)
+        steps = max(self.steps, 1)
+        scalars = {
+            'metrics/games_per_sec': self.games / max(time.time() - self.start_ts, 1e-9),
+            'metrics/turns_avg': self.turns / games,
+            'metrics/win_rate_%s' % Game.TOKENS[0]: self.wins[0] / games,
+            'metrics/win_rate_%s' % Game.TOKENS[1]: self.wins[1] / games,
+            'metrics/delta_avg': self.delta_sum / steps,
+            'metrics/loss_avg': self.loss_sum / steps,
+        }
+        self.reset()
+        return scalars
+
+
+class LatencyHistogram(object):
+    def __init__(self, low=1e-5, high=100., buckets_per_decade=20):
+        """
+        Counts of latencies in seconds in log-spaced buckets from low to
+        high. Percentiles are read at the bucket resolution, about 12%.
+        """
+        decades = np.log10(high) - np.log10(low)
+        self.edges = np.logspace(np.log10(low), np.log10(high), int(decades * buckets_per_decade) + 1)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.total = 0.
+        self.max = 0.
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.counts[np.searchsorted(self.edges, seconds)] += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, q):
+        """
+        Upper edge of the bucket holding the q-th percentile, at most the
+        largest latency seen.
+        """
+        if not self.count:
+            return 0.
+        i = int(np.searchsorted(np.cumsum(self.counts), q / 100. * self.count))
+        return min(float(self.edges[i]), self.max) if i < len(self.edges) else self.max
+
+    def summary(self):
+        count = self.count
+        return {'count': count, 'mean': self.total / max(count, 1), 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+class BackgroundWriter(object):
+    def __init__(self, max_pending=1000):
+        """
+        Runs submitted write calls in order on a daemon thread. Used by
+        the NumPy backend, TensorFlow's FileWriter is asynchronous already.
+        A failing call is logged and the following ones still run, so the
+        queue never fills up behind a dead thread.
+        """
+        self.pending = queue.Queue(max_pending)
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run, name='summary-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, fn, *args):
+        self.pending.put((fn, args))
+
+    def run(self):
+        while True:
+            fn, args = self.pending.get()
+            if fn is None:
+                return
+            try:
+                fn(*args)
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+
+    def close(self):
+        self.pending.put((None, ()))
+        self.thread.join()
+
+
+class JsonLinesWriter(object):
+    def __init__(self, path):
+        """
+        Appends one json line of scalars per summary, used by the NumPy
+        backend in place of TensorBoard event files.
+        """
+        self.path = path
+
+    def write_scalars(self, step, scalars):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(dict(scalars, step=step), sort_keys=True) + '\n')
@@ -1,5 +1,7 @@
 from __future__ import division
 
+import os
+import json
 import time
 import random
 import numpy as np
@@ -7,10 +9,29 @@ import numpy as np
 import tensorflow.compat.v1 as tf
 tf.disable_v2_behavior()
 
+import evaluation
+import run_state
 from backgammon.game import Game
-from backgammon.agents.human_agent import HumanAgent
-from backgammon.agents.random_agent import RandomAgent
 from backgammon.agents.td_gammon_agent import TDAgent
+from backgammon.features import get_encoder, outcome_targets
+from metrics import GameMetrics
+from network import Network, DEFAULT_CONFIG, layer_sizes
+
+# network config saved next to the checkpoints
+CONFIG_FILE = 'config.json'
+
+
+def read_config(checkpoint_path):
+    """
+    Network config saved with the checkpoints in checkpoint_path, None
+    when there is none (checkpoints of the default network).
+    """
+    path = os.path.join(checkpoint_path, CONFIG_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
 
 # helper to initialize a weight and bias variable
 def weight_bias(shape):
@@ -25,7 +46,7 @@ def dense_layer(x, shape, activation, name):
         return activation(tf.matmul(x, W) + b, name='activation')
 
 class Model(object):
-    def __init__(self, sess, model_path, summary_path, checkpoint_path, restore=False):
+    def __init__(self, sess, model_path, summary_path, checkpoint_path, restore=False, config=None):
         self.model_path = model_path
         self.summary_path = summary_path
         self.checkpoint_path = checkpoint_path
@@ -45,31 +66,35 @@ class Model(object):
         tf.summary.scalar('lambda', lamda)
         tf.summary.scalar('alpha', alpha)
 
-        # describe network size
-        # normal implémentation
-        # layer_size_input = 294
-        # from git using custom extraction
-        layer_size_input = 198
-        layer_size_hidden = 80
-        layer_size_output = 1
+        # describe network size, the input size depends on the encoder
+        # a restored checkpoint brings its own architecture, the settings
+        # given explicitly override it
+        self.config = dict(DEFAULT_CONFIG, **((restore and read_config(checkpoint_path)) or {}))
+        self.config.update(config or {})
+        self.encoder = get_encoder(self.config['encoder'])
+        sizes = self.layer_sizes = layer_sizes(self.config)
 
         # placeholders for input and target output
-        self.x = tf.placeholder('float', [1, layer_size_input], name='x')
-        self.V_next = tf.placeholder('float', [1, layer_size_output], name='V_next')
+        # the batch dimension is left open so that agents can evaluate all
+        # the candidate afterstates of a turn in a single run
+        self.x = tf.placeholder('float', [None, sizes[0]], name='x')
+        self.V_next = tf.placeholder('float', [None, sizes[-1]], name='V_next')
 
-        # build network arch. (just 2 layers with sigmoid activation)
-        prev_y = dense_layer(self.x, [layer_size_input, layer_size_hidden], tf.sigmoid, name='layer1')
-        self.V = dense_layer(prev_y, [layer_size_hidden, layer_size_output], tf.sigmoid, name='layer2')
+        # build network arch. (fully connected layers with sigmoid activation)
+        prev_y = self.x
+        for i in range(len(sizes) - 1):
+            prev_y = dense_layer(prev_y, [sizes[i], sizes[i + 1]], tf.sigmoid, name='layer%d' % (i + 1))
+        self.V = prev_y
 
         # watch the individual value predictions over time
         tf.summary.scalar('V_next', tf.reduce_sum(self.V_next))
         tf.summary.scalar('V', tf.reduce_sum(self.V))
 
-        # delta = V_next - V
-        delta_op = tf.reduce_sum(self.V_next - self.V, name='delta')
+        # delta = V_next - V, summed over the outputs for monitoring
+        delta_op = self.delta_op = tf.reduce_sum(self.V_next - self.V, name='delta')
 
         # mean squared error of the difference between the next state and the current state
-        loss_op = tf.reduce_mean(tf.square(self.V_next - self.V), name='loss')
+        loss_op = self.loss_op = tf.reduce_mean(tf.square(self.V_next - self.V), name='loss')
 
         # check if the model predicts the correct state
         accuracy_op = tf.reduce_sum(tf.cast(tf.equal(tf.round(self.V_next), tf.round(self.V)), dtype='float'), name='accuracy')
@@ -114,32 +139,39 @@ class Model(object):
         # increment global step: we keep this as a variable so it's saved with checkpoints
         global_step_op = self.global_step.assign_add(1)
 
-        # get gradients of output V wrt trainable variables (weights and biases)
+        # get gradients of each output V_k wrt trainable variables (weights
+        # and biases), every output has its own eligibility trace
         tvars = tf.trainable_variables()
-        grads = tf.gradients(self.V, tvars)
+        output_grads = [tf.gradients(self.V[:, k], tvars) for k in range(sizes[-1])]
 
         # watch the weight and gradient distributions
-        for grad, var in zip(grads, tvars):
+        for i, var in enumerate(tvars):
             tf.summary.histogram(var.name, var)
-            tf.summary.histogram(var.name + '/gradients/grad', grad)
+            tf.summary.histogram(var.name + '/gradients/grad', tf.add_n([grads[i] for grads in output_grads]))
 
-        # for each variable, define operations to update the var with delta,
-        # taking into account the gradient as part of the eligibility trace
-        apply_gradients = []
+        # all the eligibility traces are kept in one (outputs, params)
+        # buffer, so the update is a few fused ops instead of a set of ops
+        # per variable
         with tf.variable_scope('apply_gradients'):
-            for grad, var in zip(grads, tvars):
-                with tf.variable_scope('trace'):
-                    # e-> = lambda * e-> + <grad of output w.r.t weights>
-                    trace = tf.Variable(tf.zeros(grad.get_shape()), trainable=False, name='trace')
-                    trace_op = trace.assign((lamda * trace) + grad)
-                    tf.summary.histogram(var.name + '/traces', trace)
+            flat_grads = tf.stack([tf.concat([tf.reshape(grad, [-1]) for grad in grads], 0)
+                                   for grads in output_grads])
+            param_sizes = [int(np.prod(var.get_shape().as_list())) for var in tvars]
+
+            # e_k-> = lambda * e_k-> + <grad of output k w.r.t weights>
+            trace = self.trace = tf.Variable(tf.zeros(flat_grads.get_shape()), trainable=False, name='trace')
+            trace_op = trace.assign((lamda * trace) + flat_grads)
+            tf.summary.histogram('traces', trace)
 
-                # grad with trace = alpha * delta * e
-                grad_trace = alpha * delta_op * trace_op
-                tf.summary.histogram(var.name + '/gradients/trace', grad_trace)
+            # grad with trace = alpha * sum_k delta_k * e_k
+            deltas = tf.reduce_sum(self.V_next - self.V, axis=0)
+            grad_trace = alpha * tf.reduce_sum(tf.expand_dims(deltas, 1) * trace_op, axis=0)
+            tf.summary.histogram('gradients/trace', grad_trace)
 
-                grad_apply = var.assign_add(grad_trace)
-                apply_gradients.append(grad_apply)
+            apply_gradients = [var.assign_add(tf.reshape(update, var.get_shape()))
+                               for var, update in zip(tvars, tf.split(grad_trace, param_sizes))]
+
+            # traces must not leak from one game into the next
+            self.reset_traces_op = trace.assign(tf.zeros_like(trace))
 
         # as part of training we want to update our step and other monitoring variables
         with tf.control_dependencies([
@@ -173,34 +205,79 @@ class Model(object):
         # latest_checkpoint_path = "./checkpoints/checkpoint-24444"
         if latest_checkpoint_path:
             print('Restoring checkpoint: {0}'.format(latest_checkpoint_path))
-            self.saver.restore(self.sess, latest_checkpoint_path)
+            saved = dict(tf.train.list_variables(latest_checkpoint_path))
+            matches = lambda var: saved.get(var.op.name) == var.get_shape().as_list()
+            if all(matches(var) for var in tf.global_variables()):
+                self.saver.restore(self.sess, latest_checkpoint_path)
+                return
+            if not all(matches(var) for var in tf.trainable_variables()):
+                raise ValueError('Checkpoint %s does not match the network %s, write the encoder, hidden and '
+                                 'outputs it was trained with to %s' % (latest_checkpoint_path, self.config,
+                                                                        os.path.join(self.checkpoint_path, CONFIG_FILE)))
+
+            # checkpoints written before the traces were kept in a single
+            # (outputs, params) variable: restore the weights and the step,
+            # the traces start from zero as they do every game
+            print('Checkpoint has no matching traces, restoring the weights and global step only')
+            saver = tf.train.Saver(var_list=tf.trainable_variables() + [self.global_step])
+            saver.restore(self.sess, latest_checkpoint_path)
+            self.sess.run(self.reset_traces_op)
+
+    def export(self, path, dtype='float32'):
+        """
+        Write the trained weights to a standalone network file that can be
+        loaded for inference without TensorFlow, see network.Network.
+        """
+        variables = self.sess.run(tf.trainable_variables())
+        global_step = self.sess.run(self.global_step)
+        network = Network(variables[0::2], variables[1::2], {'global_step': int(global_step),
+                                                             'encoder': self.encoder.name})
+        network.save(path, dtype=dtype)
+        print('Exported network at step %d to %s' % (global_step, path))
 
     def get_output(self, x):
         return self.sess.run(self.V, feed_dict={ self.x: x })
 
-    def play(self):
-        game = Game.new()
-        game.play([TDAgent(Game.TOKENS[0], self), HumanAgent(Game.TOKENS[1])], draw=True)
+    def play(self, time_limit=None):
+        evaluation.play(self, time_limit=time_limit)
 
     def test(self, episodes=100, draw=False):
-        # players = [RandomAgent(Game.TOKENS[0]), RandomAgent(Game.TOKENS[1])]
-        players = [TDAgent(Game.TOKENS[0], self), RandomAgent(Game.TOKENS[1])]
-
-        winners = [0, 0]
-        for episode in range(episodes):
-            game = Game.new()
-
-            winner = game.play(players, draw=draw)
-            winners[winner] += 1
+        return evaluation.test(self, episodes=episodes, draw=draw)
 
-            winners_total = sum(winners)
-            print("[Episode %d] %s (%s) vs %s (%s) %d:%d of %d games (%.2f%%)" % (episode, \
-                players[0].name, players[0].player, \
-                players[1].name, players[1].player, \
-                winners[0], winners[1], winners_total, \
-                (winners[0] / winners_total) * 100.0))
+    def get_run_state(self):
+        """
+        Flat parameters, traces and global step of the graph.
+        """
+        tvars = tf.trainable_variables()
+        values = self.sess.run(tvars + [self.trace, self.global_step])
+        params = np.concatenate([np.ravel(v) for v in values[:len(tvars)]])
+        return params, values[-2], int(values[-1])
+
+    def set_run_state(self, params, traces, global_step):
+        offset = 0
+        for var in tf.trainable_variables():
+            shape = var.get_shape().as_list()
+            size = int(np.prod(shape))
+            var.load(params[offset:offset + size].reshape(shape), self.sess)
+            offset += size
+        # traces of single output run states were saved flat
+        self.trace.load(np.reshape(traces, self.trace.get_shape().as_list()), self.sess)
+        self.global_step.load(global_step, self.sess)
+
+    def write_scalars(self, summary_writer, step, scalars):
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)
+                                    for tag, value in sorted(scalars.items())])
+        summary_writer.add_summary(summary, global_step=step)
+
+    def train(self, resume=False, seed=None):
+        run_state_path = os.path.join(self.checkpoint_path, 'run_state')
+        snapshot_path = os.path.join(self.model_path, 'snapshots')
+        for path in [self.model_path, self.summary_path, self.checkpoint_path, snapshot_path]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        with open(os.path.join(self.checkpoint_path, CONFIG_FILE), 'w') as f:
+            json.dump(self.config, f, indent=2, sort_keys=True)
 
-    def train(self):
         tf.train.write_graph(self.sess.graph_def, self.model_path, 'td_gammon.pb', as_text=False)
         summary_writer = tf.summary.FileWriter('{0}{1}'.format(self.summary_path, int(time.time()), self.sess.graph_def))
 
@@ -219,31 +296,61 @@ class Model(object):
         #             RandomAgent(Game.TOKENS[1])]
 
         validation_interval = 100
+        # the saver keeps a single checkpoint, exported snapshots are kept
+        # for tournaments between model generations
+        snapshot_interval = 1000
+        # scalars are aggregated over windows of games, the full summaries
+        # with all the histograms are only written at a sparse interval
+        metrics_window = 100
+        histogram_interval = 1000
         episodes = 150000
 
+        # a run state is saved every state_interval games, the variables
+        # alone are not enough to resume a run deterministically
+        state_interval = 100
+
+        # FileWriter already writes its events on a background thread
+        metrics = GameMetrics(window=metrics_window)
+
+        # dice and starting players come from their own generator, saved
+        # with the run state
+        rng = random.Random(seed)
+        start_episode = 0
+        path = run_state.latest(run_state_path) if resume else None
+        if path:
+            print('Resuming run state: %s' % path)
+            params, traces, meta = run_state.load(path)
+            self.set_run_state(params, traces, meta['global_step'])
+            start_episode = meta['episode']
+            run_state.set_rng_state(rng, meta['dice_random'])
+            metrics.load_state(meta['metrics'])
+
         train_start_ts = time.time()
-        for episode in range(episodes):
+        for episode in range(start_episode, episodes):
             if episode != 0 and episode % validation_interval == 0:
                 self.test(episodes=100)
 
             start_ts = time.time()
-            game = Game.new()
+            game = Game.new(rng=rng)
+            self.sess.run(self.reset_traces_op)
 
-            player_num = random.randint(0, 1)
+            player_num = rng.randint(0, 1)
 
-            x = game.extract_features(players[player_num].player)
+            x = self.encoder.encode(game, players[player_num].player)
 
             game_step = 0
             while not game.is_over():
                 game.next_step(players[player_num], player_num)
                 player_num = (player_num + 1) % 2
 
-                x_next = game.extract_features(players[player_num].player)
+                x_next = self.encoder.encode(game, players[player_num].player)
                 V_next = self.get_output(x_next)
                 # game.draw()
                 # a = input("--")
 
-                self.sess.run(self.train_op, feed_dict={ self.x: x, self.V_next: V_next })
+                _, delta, loss = self.sess.run([self.train_op, self.delta_op, self.loss_op],
+                                               feed_dict={ self.x: x, self.V_next: V_next })
+                metrics.add_step(delta, loss)
 
                 x = x_next
                 game_step += 1
@@ -252,20 +359,34 @@ class Model(object):
 
             winner = game.winner()
 
-            _, global_step, summaries, _ = self.sess.run([
-                self.train_op,
-                self.global_step,
-                self.summaries_op,
-                self.reset_op
-            ], feed_dict={ self.x: x, self.V_next: np.array([[winner]], dtype='float') })
+            fetches = [self.train_op, self.delta_op, self.loss_op, self.global_step]
+            if (episode + 1) % histogram_interval == 0:
+                fetches.append(self.summaries_op)
+            results = self.sess.run(fetches, feed_dict={ self.x: x, self.V_next: outcome_targets(game, self.config['outputs']) })
+            _, delta, loss, global_step = results[:4]
+            self.sess.run(self.reset_op)
 
-            summary_writer.add_summary(summaries, global_step=global_step)
+            metrics.add_step(delta, loss)
+            metrics.add_game(game_step, winner)
+            if metrics.ready():
+                self.write_scalars(summary_writer, global_step, metrics.flush())
+            if len(results) > 4:
+                summary_writer.add_summary(results[4], global_step)
 
             end_ts = time.time()
             print("Game %d/%d (Winner: %s) in %d turns (%.2f secs)" % (episode, episodes, players[winner].player, game_step, end_ts-start_ts))
             if episode in [9, 99, 999, 9999, 99999]:
                 print("%d games avg time: %.2f secs" % (episode+1, (end_ts - train_start_ts) / (episode+1)))
             self.saver.save(self.sess, self.checkpoint_path + 'checkpoint', global_step=global_step)
+            if (episode + 1) % snapshot_interval == 0:
+                self.export(os.path.join(snapshot_path, 'td_gammon-%d.tdg' % global_step))
+            if (episode + 1) % state_interval == 0:
+                params, traces, global_step = self.get_run_state()
+                run_state.save(run_state_path, params, traces, {
+                    'global_step': global_step,
+                    'episode': episode + 1,
+                    'dice_random': run_state.rng_state(rng),
+                    'metrics': metrics.state()})
 
         summary_writer.close()
 
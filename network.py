@@ -0,0 +1,310 @@
+"""
+NumPy inference for a trained TD-Gammon network.
+
+The weights are stored in a small versioned binary file:
+
+    magic (4 bytes) | version (uint16) | metadata length (uint32)
+    metadata (utf-8 json) | padding | arrays
+
+Each array starts on a 64 byte boundary and is described in the metadata
+(name, dtype, shape and offset from the start of the data section). Files
+are opened with a read-only memory map so that every process playing with
+the same network shares one physical copy of the weights.
+
+Weights can be stored in reduced precision for evaluation-only use:
+float16, bfloat16 (the upper half of a float32, kept as uint16) or int8
+with one float32 scale per output column. Biases always stay float32.
+"""
+from __future__ import division
+
+import json
+import struct
+
+import numpy as np
+
+from backgammon.game import Game
+from backgammon.features import get_encoder
+
+MAGIC = b'TDGN'
+VERSION = 1
+ALIGN = 64
+HEADER = struct.Struct('<4sHI')
+
+DTYPES = ['float32', 'float16', 'bfloat16', 'int8']
+
+# network architecture, the input size comes from the encoder
+DEFAULT_CONFIG = {'encoder': 'td198', 'hidden': [80], 'outputs': 1}
+
+
+def layer_sizes(config):
+    return [get_encoder(config['encoder']).size] + list(config['hidden']) + [config['outputs']]
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def to_bfloat16(x):
+    """
+    Round float32 values to bfloat16, returned as their uint16 bit pattern.
+    """
+    bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32).astype(np.uint64)
+    bits = (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16
+    return bits.astype(np.uint16)
+
+
+def from_bfloat16(x):
+    return np.left_shift(x, 16, dtype=np.uint32).view(np.float32)
+
+
+def quantize_int8(W):
+    """
+    Symmetric int8 quantization with one scale per output column.
+    """
+    W = np.asarray(W, dtype=np.float32)
+    scale = np.abs(W).max(axis=0) / 127.
+    scale[scale == 0.] = 1.
+    Wq = np.clip(np.round(W / scale), -127, 127).astype(np.int8)
+    return Wq, scale.astype(np.float32)
+
+
+class Network(object):
+    def __init__(self, weights, biases, metadata=None, precision='float32', scales=None):
+        """
+        Fully connected sigmoid network, weights[i] has shape
+        (layer_size_in, layer_size_out) and biases[i] (layer_size_out,).
+        For int8 networks scales[i] holds the (layer_size_out,) column scales.
+        """
+        self.weights = list(weights)
+        self.biases = list(biases)
+        self.metadata = dict(metadata or {})
+        self.precision = precision
+        self.scales = list(scales) if scales is not None else [None] * len(self.weights)
+
+    @property
+    def layer_sizes(self):
+        return [self.weights[0].shape[0]] + [W.shape[1] for W in self.weights]
+
+    @property
+    def encoder(self):
+        return get_encoder(self.metadata.get('encoder', DEFAULT_CONFIG['encoder']))
+
+    def get_output(self, x):
+        """
+        Same contract as Model.get_output: x is a (batch, inputs) array,
+        returns a (batch, outputs) array.
+
+        Reduced precision weights are used as stored, no float32 copy is
+        kept: each layer widens its matrix for the product only (faster
+        than a mixed dtype np.dot) and the int8 column scales are applied
+        to the (batch, outputs) result instead of the weights.
+        """
+        y = np.asarray(x, dtype=np.float32)
+        for W, b, scale in zip(self.weights, self.biases, self.scales):
+            if self.precision == 'bfloat16':
+                W = from_bfloat16(W)
+            elif self.precision != 'float32':
+                W = W.astype(np.float32)
+            z = np.dot(y, W)
+            if scale is not None:
+                z *= scale
+            y = sigmoid(z + b)
+        return y
+
+    def dequantize(self):
+        """
+        float32 copy of the network.
+        """
+        weights = []
+        for W, scale in zip(self.weights, self.scales):
+            if self.precision == 'bfloat16':
+                W = from_bfloat16(W)
+            W = np.asarray(W, dtype=np.float32)
+            weights.append(W * scale if scale is not None else W.copy())
+        biases = [np.array(b, dtype=np.float32) for b in self.biases]
+        return Network(weights, biases, self.metadata)
+
+    def quantize(self, dtype):
+        """
+        Copy of the network with its weights stored as dtype.
+        """
+        if dtype not in DTYPES:
+            raise ValueError('Unknown dtype %s, expected one of %s' % (dtype, DTYPES))
+
+        network = self.dequantize() if self.precision != 'float32' else self
+        weights, scales = [], []
+        for W in network.weights:
+            scale = None
+            if dtype == 'int8':
+                W, scale = quantize_int8(W)
+            elif dtype == 'bfloat16':
+                W = to_bfloat16(W)
+            else:
+                W = np.asarray(W, dtype=dtype)
+            weights.append(W)
+            scales.append(scale)
+        biases = [np.asarray(b, dtype=np.float32) for b in network.biases]
+        return Network(weights, biases, self.metadata, precision=dtype, scales=scales)
+
+    def arrays(self):
+        """
+        Named arrays in the order they are written to disk.
+        """
+        arrays = []
+        for i, (W, b, scale) in enumerate(zip(self.weights, self.biases, self.scales)):
+            arrays.append(('layer%d/weight' % (i + 1), W))
+            arrays.append(('layer%d/bias' % (i + 1), b))
+            if scale is not None:
+                arrays.append(('layer%d/scale' % (i + 1), scale))
+        return arrays
+
+    def save(self, path, dtype=None):
+        """
+        Write the network to path, storing the weights as dtype (defaults
+        to the current precision).
+        """
+        network = self.quantize(dtype) if dtype and dtype != self.precision else self
+
+        entries = []
+        blobs = []
+        offset = 0
+        for name, array in network.arrays():
+            array = np.ascontiguousarray(array)
+            data = array.tobytes()
+            entries.append({'name': name, 'dtype': array.dtype.name,
+                            'shape': list(array.shape), 'offset': offset})
+            blobs.append((offset, data))
+            offset = _align(offset + len(data))
+
+        metadata = dict(network.metadata)
+        metadata.update({'layers': network.layer_sizes, 'activation': 'sigmoid',
+                         'precision': network.precision, 'arrays': entries})
+        meta = json.dumps(metadata, sort_keys=True).encode('utf-8')
+        data_start = _align(HEADER.size + len(meta))
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(meta)))
+            f.write(meta)
+            for blob_offset, data in blobs:
+                f.seek(data_start + blob_offset)
+                f.write(data)
+            # make sure the file covers the padding of the last array
+            f.truncate(data_start + offset)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        Load a network written by save. With mmap the arrays are read-only
+        views on the file, otherwise they are read into memory.
+        """
+        if mmap:
+            buf = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            buf = np.fromfile(path, dtype=np.uint8)
+
+        magic, version, meta_len = HEADER.unpack(buf[:HEADER.size].tobytes())
+        if magic != MAGIC:
+            raise ValueError('%s is not a TD-Gammon network file' % path)
+        if version > VERSION:
+            raise ValueError('%s has version %d, this reader supports up to %d' % (path, version, VERSION))
+
+        metadata = json.loads(buf[HEADER.size:HEADER.size + meta_len].tobytes().decode('utf-8'))
+        data_start = _align(HEADER.size + meta_len)
+
+        arrays = {}
+        for entry in metadata.pop('arrays'):
+            dtype = np.dtype(entry['dtype'])
+            shape = tuple(entry['shape'])
+            start = data_start + entry['offset']
+            end = start + dtype.itemsize * int(np.prod(shape))
+            arrays[entry['name']] = buf[start:end].view(dtype).reshape(shape)
+
+        num_layers = len(metadata['layers']) - 1
+        weights = [arrays['layer%d/weight' % (i + 1)] for i in range(num_layers)]
+        biases = [arrays['layer%d/bias' % (i + 1)] for i in range(num_layers)]
+        scales = [arrays.get('layer%d/scale' % (i + 1)) for i in range(num_layers)]
+        precision = metadata.pop('precision', 'float32')
+        return Network(weights, biases, metadata, precision=precision, scales=scales)
+
+
+class IncrementalEvaluator(object):
+    """
+    Evaluates candidate moves from the board cells they change, NNUE
+    style. With encoders where every feature depends on a single board
+    cell (a point, the bar or the tray of one player), the hidden
+    pre-activations of a position are a sum of one weight row per cell
+    and piece count. Those rows are tabulated once, so the afterstates
+    of a move only gather the rows of their changed cells and add them
+    to the pre-activations of the current position.
+    """
+    ENCODERS = ['td198', 'td294']
+    MAX_PIECES = 15
+
+    def __init__(self, network):
+        encoder = network.encoder
+        if encoder.name not in self.ENCODERS:
+            raise ValueError('Incremental evaluation needs one of the %s encoders, not %s'
+                             % (self.ENCODERS, encoder.name))
+        self.network = network
+        first = network.dequantize() if network.precision != 'float32' else network
+        self.W = np.asarray(first.weights[0], dtype=np.float32)
+        self.b = np.asarray(first.biases[0], dtype=np.float32)
+        self.tail = Network(network.weights[1:], network.biases[1:], precision=network.precision,
+                            scales=network.scales[1:])
+
+        # pre-activations of the empty board for each player to move, and
+        # the rows added by n pieces on each of the 2 * 26 cells
+        cells = 2 * (Game.NUMCOLS + 2)
+        empty = np.zeros((2, 2, Game.NUMCOLS + 2), dtype=np.int8)
+        empty = encoder.encode_batch(empty, np.arange(2))
+        self.empty = np.dot(empty, self.W) + self.b
+        boards = np.zeros((cells, self.MAX_PIECES + 1, cells), dtype=np.int8)
+        counts = np.arange(self.MAX_PIECES + 1, dtype=np.int8)
+        boards[np.arange(cells), :, np.arange(cells)] = counts
+        features = encoder.encode_batch(boards.reshape(-1, 2, Game.NUMCOLS + 2), np.zeros(len(counts) * cells))
+        self.table = np.dot(features - empty[0], self.W).reshape(cells, len(counts), -1)
+
+    @property
+    def encoder(self):
+        return self.network.encoder
+
+    @property
+    def layer_sizes(self):
+        return self.network.layer_sizes
+
+    def position_pre(self, board, turn):
+        """
+        Pre-activations of the first layer for one board array, the player
+        of index turn to move.
+        """
+        cells = board.reshape(-1)
+        return self.empty[turn] + self.table[np.arange(len(cells)), cells].sum(axis=0)
+
+    def get_output(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        return self.tail.get_output(sigmoid(np.dot(x, self.W) + self.b))
+
+    def evaluate_actions(self, game, actions, player):
+        """
+        Same values as get_output(game.afterstate_features(actions, player)).
+        """
+        base = game.board_array().reshape(-1)
+        turn = game.players.index(game.opponent(player))
+        boards = game.afterstate_boards(actions, player).reshape(len(actions), -1)
+
+        # the moves of a roll share few (cell, count) changes: their rows
+        # are gathered once and summed per move by one small product
+        rows, cells = np.nonzero(boards != base)
+        counts = self.MAX_PIECES + 1
+        changes, index = np.unique(cells * counts + boards[rows, cells], return_inverse=True)
+        changed = changes // counts
+        table = self.table.reshape(-1, self.table.shape[-1])
+        delta = table[changes] - table[changed * counts + base[changed]]
+        moves = np.zeros((len(actions), len(changes)), dtype=np.float32)
+        moves[rows, index.reshape(-1)] = 1.
+        pre = self.position_pre(base, turn) + np.dot(moves, delta)
+        return self.tail.get_output(sigmoid(pre))
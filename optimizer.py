@@ -0,0 +1,169 @@
+"""
+TD(lambda) with eligibility traces on the NumPy network.
+
+All the parameters live in one contiguous float32 buffer and the network
+weights and biases are views into it, so are the gradients and the traces.
+Every output V_k has its own trace e_k, the traces and the gradients are
+(outputs, params) buffers. A training step is a forward/backward pass
+followed by a few fused operations over the whole buffer:
+
+    e_k = lambda * e_k + grad(V_k)
+    params += alpha * sum_k delta_k * e_k
+"""
+from __future__ import division
+
+import numpy as np
+
+from network import Network
+
+
+def lamda_schedule(global_step):
+    # same decay as the TensorFlow graph
+    return max(0.7, 0.9 * 0.96 ** (global_step // 30000))
+
+
+def alpha_schedule(global_step):
+    return max(0.01, 0.1 * 0.96 ** (global_step // 40000))
+
+
+def truncated_normal(rng, shape, stddev):
+    """
+    Normal values redrawn until they are within two standard deviations,
+    like tf.truncated_normal.
+    """
+    values = rng.normal(0., stddev, shape)
+    outside = np.abs(values) > 2 * stddev
+    while outside.any():
+        values[outside] = rng.normal(0., stddev, outside.sum())
+        outside = np.abs(values) > 2 * stddev
+    return values
+
+
+class TDLambda(object):
+    def __init__(self, layer_sizes, params=None, seed=None, encoder='td198'):
+        """
+        Sigmoid network of the given layer sizes trained with TD(lambda),
+        on the inputs of encoder. params is an optional flat buffer of
+        initial parameters, otherwise weights are drawn like the TensorFlow
+        graph (truncated normal with stddev 0.1, biases 0.1).
+        """
+        self.layer_sizes = list(layer_sizes)
+        shapes = []
+        for n_in, n_out in zip(self.layer_sizes[:-1], self.layer_sizes[1:]):
+            shapes += [(n_in, n_out), (n_out,)]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        offsets = np.cumsum([0] + sizes)
+
+        outputs = self.layer_sizes[-1]
+        self.params = np.empty(offsets[-1], dtype=np.float32)
+        self.grads = np.zeros((outputs, offsets[-1]), dtype=np.float32)
+        self.traces = np.zeros_like(self.grads)
+
+        def views(buf):
+            return [buf[..., offsets[i]:offsets[i + 1]].reshape(buf.shape[:-1] + shape)
+                    for i, shape in enumerate(shapes)]
+
+        param_views = views(self.params)
+        grad_views = views(self.grads)
+        self.weights, self.biases = param_views[0::2], param_views[1::2]
+        self.weight_grads, self.bias_grads = grad_views[0::2], grad_views[1::2]
+
+        if params is not None:
+            self.params[:] = params
+        else:
+            rng = np.random.RandomState(seed)
+            for W, b in zip(self.weights, self.biases):
+                W[:] = truncated_normal(rng, W.shape, 0.1)
+                b[:] = 0.1
+
+        self.network = Network(self.weights, self.biases, {'encoder': encoder})
+        self.global_step = 0
+
+    @staticmethod
+    def from_network(network):
+        network = network.dequantize() if network.precision != 'float32' else network
+        params = np.concatenate([np.ravel(a) for _, a in network.arrays()])
+        optimizer = TDLambda(network.layer_sizes, params=params, encoder=network.encoder.name)
+        optimizer.global_step = network.metadata.get('global_step', 0)
+        return optimizer
+
+    def get_output(self, x):
+        return self.network.get_output(x)
+
+    def gradient(self, x):
+        """
+        Fill self.grads with the gradient of each output for the single
+        input x and return the outputs.
+        """
+        activations = [np.asarray(x, dtype=np.float32).reshape(1, -1)]
+        for W, b in zip(self.weights, self.biases):
+            activations.append(1. / (1. + np.exp(-(np.dot(activations[-1], W) + b))))
+
+        # row k of g is backpropagated from output k alone
+        V = activations[-1]
+        g = np.diag((V * (1. - V))[0])
+        for i in reversed(range(len(self.weights))):
+            np.multiply(activations[i][0][np.newaxis, :, np.newaxis], g[:, np.newaxis, :],
+                        out=self.weight_grads[i])
+            self.bias_grads[i][:] = g
+            if i > 0:
+                a = activations[i]
+                g = np.dot(g, self.weights[i].T) * a * (1. - a)
+        return V
+
+    def update(self, x, V_next):
+        """
+        One TD(lambda) step from the position x towards V_next, returns
+        the value of x before the update and delta summed over the
+        outputs.
+        """
+        V = self.gradient(x)
+        deltas = (np.asarray(V_next, dtype=np.float32) - V).reshape(-1)
+
+        self.traces *= lamda_schedule(self.global_step)
+        self.traces += self.grads
+        self.params += alpha_schedule(self.global_step) * np.dot(deltas, self.traces)
+
+        self.global_step += 1
+        return V, float(np.sum(deltas))
+
+    def reset_traces(self):
+        self.traces.fill(0.)
+
+
+def check_gradients(layer_sizes, seed=0, eps=1e-3, tolerance=2e-3):
+    """
+    Compare the gradient of every output with finite differences on a
+    sample of parameters, and check that an error on one output only
+    moves the last layer weights of that output. Raises AssertionError.
+    """
+    rng = np.random.RandomState(seed)
+    optimizer = TDLambda(layer_sizes, seed=seed)
+    x = rng.rand(layer_sizes[0]).astype(np.float32)
+    V = optimizer.gradient(x).copy()
+    grads = optimizer.grads.copy()
+    params = optimizer.params.copy()
+
+    for i in rng.choice(len(params), min(len(params), 50), replace=False):
+        optimizer.params[:] = params
+        optimizer.params[i] += eps
+        V_plus = optimizer.get_output(x.reshape(1, -1))
+        optimizer.params[i] -= 2 * eps
+        V_minus = optimizer.get_output(x.reshape(1, -1))
+        numeric = (V_plus - V_minus)[0] / (2 * eps)
+        assert np.allclose(numeric, grads[:, i], atol=tolerance), \
+            'gradient of parameter %d is %s, finite differences give %s' % (i, grads[:, i], numeric)
+
+    before = TDLambda(layer_sizes, params=params)
+    for k in range(layer_sizes[-1]):
+        optimizer.params[:] = params
+        optimizer.reset_traces()
+        V_next = V.copy()
+        V_next[0, k] += 0.5
+        optimizer.update(x, V_next)
+        W = optimizer.weights[-1] - before.weights[-1]
+        b = optimizer.biases[-1] - before.biases[-1]
+        others = [j for j in range(layer_sizes[-1]) if j != k]
+        assert not np.any(W[:, others]) and not np.any(b[others]), \
+            'an error on output %d moved the weights of other outputs' % k
+        assert np.any(b[k]), 'an error on output %d did not move its bias' % k
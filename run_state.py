@@ -0,0 +1,69 @@
+"""
+Run state of a training run, enough to resume it exactly.
+
+A run state is an .npz file holding the flat parameters and eligibility
+traces, plus a json document with the global step, the episode, the state
+of the dice and python random generators and the metric accumulators.
+Files are written to a temporary name, synced and renamed, and the last
+few are kept, so an interruption during a save never loses the run.
+"""
+import os
+import io
+import glob
+import json
+import random
+
+import numpy as np
+
+
+def rng_state(rng):
+    version, internal, gauss = rng.getstate()
+    return [version, list(internal), gauss]
+
+
+def set_rng_state(rng, state):
+    version, internal, gauss = state
+    rng.setstate((version, tuple(internal), gauss))
+
+
+def save(directory, params, traces, meta, keep=3):
+    """
+    Write a run state named after meta['global_step'] and remove the
+    older ones beyond keep.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    meta = dict(meta, python_random=rng_state(random))
+    buf = io.BytesIO()
+    np.savez(buf, params=params, traces=traces,
+             meta=np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8))
+
+    path = os.path.join(directory, 'run-%010d.npz' % meta['global_step'])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(buf.getvalue())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    for old in sorted(glob.glob(os.path.join(directory, 'run-*.npz')))[:-keep]:
+        os.remove(old)
+    return path
+
+
+def latest(directory):
+    paths = sorted(glob.glob(os.path.join(directory, 'run-*.npz')))
+    return paths[-1] if paths else None
+
+
+def load(path):
+    """
+    Returns params, traces and meta, and restores the python random state.
+    """
+    with np.load(path) as data:
+        params = data['params']
+        traces = data['traces']
+        meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+    set_rng_state(random, meta['python_random'])
+    return params, traces, meta
@@ -0,0 +1,226 @@
+"""
+Local inference service.
+
+One process holds the network and answers get_output requests from many
+clients over a Unix socket. Requests from all connections go through a
+single queue and are evaluated in micro-batches: a batch is closed when it
+holds max_batch positions or when its oldest request has waited
+max_delay seconds, whichever comes first.
+
+A lone request is evaluated right away instead of waiting for others.
+
+Wire format, little endian, in both directions:
+
+    rows (uint32) | cols (uint32) | rows * cols float32
+
+A request the server cannot evaluate, e.g. with the wrong number of
+columns, is answered with ERROR in place of rows, the length of a utf-8
+message in place of cols, then the message. The connection stays open.
+"""
+from __future__ import division
+
+import os
+import time
+import queue
+import socket
+import struct
+import threading
+import socketserver
+
+import numpy as np
+
+HEADER = struct.Struct('<II')
+ERROR = 0xFFFFFFFF
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('Connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def send_array(sock, array):
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    sock.sendall(HEADER.pack(array.shape[0], array.shape[1]) + array.tobytes())
+
+
+def send_error(sock, message):
+    data = message.encode('utf-8')
+    sock.sendall(HEADER.pack(ERROR, len(data)) + data)
+
+
+def recv_array(sock):
+    rows, cols = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    if rows == ERROR:
+        raise ValueError(_recv_exactly(sock, cols).decode('utf-8'))
+    data = _recv_exactly(sock, rows * cols * 4)
+    return np.frombuffer(data, dtype=np.float32).reshape(rows, cols)
+
+
+class Request(object):
+    def __init__(self, x):
+        self.x = x
+        self.output = None
+        self.error = None
+        self.received_ts = time.time()
+        self.done = threading.Event()
+
+
+class Batcher(object):
+    def __init__(self, model, max_batch=512, max_delay=0.002):
+        """
+        Evaluates queued requests with model in micro-batches.
+        """
+        self.model = model
+        # input size of the model, when it tells
+        sizes = getattr(model, 'layer_sizes', None)
+        self.inputs = sizes[0] if sizes else None
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.positions = 0
+        self.latencies = []
+        self.thread = threading.Thread(target=self.run, name='batcher')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def evaluate(self, x):
+        """
+        Called from the connection threads, blocks until x is evaluated.
+        """
+        request = Request(x)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        # nobody else is waiting, do not make this request wait for them
+        if self.requests.empty():
+            return batch
+        rows = len(batch[0].x)
+        deadline = batch[0].received_ts + self.max_delay
+        while rows < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            rows += len(request.x)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                output = self.model.get_output(np.concatenate([r.x for r in batch]))
+            except Exception:
+                # evaluate the requests one by one so only the faulty ones
+                # fail
+                for request in batch:
+                    try:
+                        request.output = self.model.get_output(request.x)
+                    except Exception as e:
+                        request.error = e
+                    request.done.set()
+                continue
+
+            start = 0
+            now = time.time()
+            for request in batch:
+                request.output = output[start:start + len(request.x)]
+                start += len(request.x)
+                self.latencies.append(now - request.received_ts)
+                request.done.set()
+
+            self.batches += 1
+            self.positions += start
+            # keep the latency window bounded
+            del self.latencies[:-10000]
+
+    def stats(self):
+        latencies = np.array(self.latencies or [0.]) * 1000.
+        return "%d batches, %d positions (%.1f per batch), latency p50 %.2f ms, p99 %.2f ms" % (
+            self.batches, self.positions, self.positions / max(self.batches, 1),
+            np.percentile(latencies, 50), np.percentile(latencies, 99))
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                x = recv_array(self.request)
+            except EOFError:
+                return
+            batcher = self.server.batcher
+            # a bad request must not fail the batch of the other clients
+            if batcher.inputs is not None and x.shape[1] != batcher.inputs:
+                send_error(self.request, 'Expected %d columns, got %d' % (batcher.inputs, x.shape[1]))
+                continue
+            try:
+                output = batcher.evaluate(x)
+            except Exception as e:
+                send_error(self.request, 'Evaluation failed: %r' % e)
+                continue
+            send_array(self.request, output)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, model, max_batch=512, max_delay=0.002):
+        if os.path.exists(path):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.batcher = Batcher(model, max_batch=max_batch, max_delay=max_delay)
+        self.batcher.start()
+
+    def serve(self, stats_interval=60):
+        """
+        Serve until interrupted, printing the batching statistics every
+        stats_interval seconds.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            while thread.is_alive():
+                thread.join(stats_interval)
+                print(self.batcher.stats())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+            self.server_close()
+            os.remove(self.server_address)
+
+
+class InferenceClient(object):
+    def __init__(self, path):
+        """
+        Thin client with the get_output interface of Model and Network.
+        """
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+
+    def get_output(self, x):
+        with self.lock:
+            send_array(self.sock, x)
+            return recv_array(self.sock)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,179 @@
+"""
+asyncio session manager for human vs TD-Gammon games.
+
+Every connection on the local socket plays its own game with a line
+protocol: the server sends the board and the roll, the human answers with
+one line holding the whole move as "start,end" pairs separated by spaces,
+e.g. "0,2 0,4" ("on" for the bar, "off" to bear off). Bot moves are
+computed on a thread or process pool so the event loop never stalls, and
+the pauses between turns are asyncio sleeps instead of time.sleep.
+"""
+import io
+import time
+import random
+import asyncio
+import itertools
+import concurrent.futures
+
+from backgammon.game import Game
+from backgammon.agents.human_agent import HumanAgent
+from backgammon.agents.td_gammon_agent import TDAgent
+from backgammon.agents.anytime_agent import AnytimeAgent
+from metrics import LatencyHistogram
+
+# model used by the bot workers of this process, and the anytime agents
+# per player when moves have a time limit
+_model = None
+_agents = {}
+_time_limit = None
+
+
+def init_worker(weights, server='', time_limit=None):
+    global _model, _time_limit
+    _time_limit = time_limit
+    if server:
+        from server import InferenceClient
+        _model = InferenceClient(server)
+    else:
+        from network import Network
+        _model = Network.load(weights)
+
+
+def choose_move(player, moves, game):
+    if _time_limit:
+        # kept across moves, they learn the cost of the search
+        if player not in _agents:
+            _agents[player] = AnytimeAgent(player, _model, time_limit=_time_limit)
+        return _agents[player].get_action(moves, game)
+    return TDAgent(player, _model).get_action(moves, game)
+
+
+class GameSession(object):
+    def __init__(self, manager, reader, writer):
+        self.manager = manager
+        self.reader = reader
+        self.writer = writer
+        self.game = Game.new(rng=random.Random())
+        self.bot = Game.TOKENS[0]
+        self.human = HumanAgent(Game.TOKENS[1])
+
+    async def send(self, text):
+        self.writer.write(text.encode('utf-8'))
+        await self.writer.drain()
+
+    async def send_board(self):
+        out = io.StringIO()
+        self.game.draw(out)
+        await self.send(out.getvalue() + '\n')
+
+    async def read_line(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.manager.idle_timeout)
+        if not line:
+            raise ConnectionResetError('Client left the game')
+        return line.decode('utf-8').strip()
+
+    def parse_move(self, line, moves):
+        """
+        Return the legal move matching line, in any order of its steps.
+        """
+        steps = [self.human.get_formatted_move(step) for step in line.split()]
+        if not steps or not all(steps):
+            return None
+        for move in itertools.permutations(steps):
+            if move in moves:
+                return move
+        return None
+
+    async def human_move(self, moves):
+        if not moves:
+            await self.send('No moves for you...(hit enter)\n')
+            await self.read_line()
+            return None
+        while True:
+            await self.send('Your move ("<start>,<end> ..." with "%s" for the bar and "%s" to bear off): ' % (Game.ON, Game.OFF))
+            move = self.parse_move(await self.read_line(), moves)
+            if move:
+                return move
+            await self.send("You can't play that move\n")
+
+    async def bot_move(self, moves):
+        if not moves:
+            return None
+        loop = asyncio.get_running_loop()
+        start_ts = time.time()
+        move = await loop.run_in_executor(self.manager.executor, choose_move, self.bot, moves, self.game)
+        # the latency seen by the player, waiting for a worker included
+        self.manager.latency.add(time.time() - start_ts)
+        return move
+
+    async def run(self):
+        game = self.game
+        player_num = game.rng.randint(0, 1)
+        while not game.is_over():
+            player = Game.TOKENS[player_num]
+            roll = game.roll_dice()
+
+            await self.send_board()
+            await self.send('Player %s rolled <%d, %d>.\n' % (player, roll[0], roll[1]))
+            await asyncio.sleep(self.manager.pace)
+
+            moves = game.get_actions_doubles(roll, player, nodups=True)
+            if player == self.bot:
+                move = await self.bot_move(moves)
+            else:
+                move = await self.human_move(moves)
+            if move:
+                game.take_action(move, player)
+            player_num = (player_num + 1) % 2
+
+        await self.send_board()
+        winner = game.players[game.winner()]
+        await self.send('You won!\n' if winner == self.human.player else 'TD-Gammon won.\n')
+
+
+class SessionManager(object):
+    def __init__(self, weights='', server='', workers=4, processes=False, pace=0.5, idle_timeout=600,
+                 time_limit=None):
+        """
+        Host concurrent games, the bots evaluate positions with the network
+        file weights or through the inference server socket. With
+        time_limit, bots play the best move found in that many seconds.
+        """
+        if processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker,
+                                                                   initargs=(weights, server, time_limit))
+        else:
+            init_worker(weights, server, time_limit)
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.pace = pace
+        self.idle_timeout = idle_timeout
+        self.sessions = 0
+        self.latency = LatencyHistogram()
+
+    async def handle(self, reader, writer):
+        self.sessions += 1
+        try:
+            await GameSession(self, reader, writer).run()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+            summary = self.latency.summary()
+            if summary['count']:
+                print('Bot move latency: p50 %.1f ms, p99 %.1f ms, max %.1f ms over %d moves' % (
+                    summary['p50'] * 1e3, summary['p99'] * 1e3, summary['max'] * 1e3, summary['count']))
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving games on %s:%d' % (host, port))
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host='127.0.0.1', port=8765):
+        try:
+            asyncio.run(self.serve(host, port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown()
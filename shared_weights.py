@@ -0,0 +1,177 @@
+"""
+Weight broadcast to actor processes through shared memory.
+
+The learner publishes its flat float32 parameters (see optimizer.TDLambda)
+into a multiprocessing.shared_memory block, and actors evaluate the
+network directly on the block, without copying it or reading any file.
+Layout of the block:
+
+    version (uint64) | current slot (uint64) | slot sequences (2 x uint64)
+    metadata length (uint32) | metadata (utf-8 json) | padding | 2 slots
+
+Every publish writes the slot the readers are not using, with a seqlock:
+the slot sequence is odd while the slot is written. Then it switches the
+current slot and increments the version. A reader checks the sequence of
+its slot around every evaluation and evaluates again in the rare case the
+slot was rewritten meanwhile, so it never uses torn weights.
+"""
+from __future__ import division
+
+import json
+import struct
+import multiprocessing.shared_memory
+from multiprocessing import resource_tracker
+
+import numpy as np
+
+from network import Network
+
+HEADER = struct.Struct('<QQQQI')
+ALIGN = 64
+SLOTS = 2
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _views(buf, layer_sizes):
+    """
+    Weights and biases viewed in a flat parameter buffer, in the order of
+    TDLambda.
+    """
+    weights, biases = [], []
+    offset = 0
+    for n_in, n_out in zip(layer_sizes[:-1], layer_sizes[1:]):
+        weights.append(buf[offset:offset + n_in * n_out].reshape(n_in, n_out))
+        offset += n_in * n_out
+        biases.append(buf[offset:offset + n_out])
+        offset += n_out
+    return weights, biases
+
+
+def num_params(layer_sizes):
+    return sum(n_in * n_out + n_out for n_in, n_out in zip(layer_sizes[:-1], layer_sizes[1:]))
+
+
+class _Block(object):
+    def __init__(self, shm):
+        self.shm = shm
+        self.header = np.ndarray(4, dtype=np.uint64, buffer=shm.buf)
+        meta_len = HEADER.unpack_from(shm.buf)[-1]
+        self.metadata = json.loads(bytes(shm.buf[HEADER.size:HEADER.size + meta_len]).decode('utf-8'))
+        self.layer_sizes = self.metadata['layers']
+
+        size = num_params(self.layer_sizes)
+        start = _align(HEADER.size + meta_len)
+        stride = _align(size * 4)
+        self.slots = [np.ndarray(size, dtype=np.float32, buffer=shm.buf, offset=start + k * stride)
+                      for k in range(SLOTS)]
+
+    @property
+    def version(self):
+        return int(self.header[0])
+
+    def close(self):
+        # the numpy views must go before the buffer can be released
+        self.header = self.slots = None
+        self.shm.close()
+
+
+class WeightPublisher(_Block):
+    def __init__(self, layer_sizes, metadata=None, name=None):
+        """
+        Create a shared block for a network of the given layer sizes.
+        Actors attach to it by name with WeightSubscriber.
+        """
+        metadata = dict(metadata or {}, layers=list(layer_sizes))
+        meta = json.dumps(metadata, sort_keys=True).encode('utf-8')
+        size = _align(HEADER.size + len(meta)) + SLOTS * _align(num_params(layer_sizes) * 4)
+
+        shm = multiprocessing.shared_memory.SharedMemory(name=name, create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, 0, 0, 0, 0, len(meta))
+        shm.buf[HEADER.size:HEADER.size + len(meta)] = meta
+        super(WeightPublisher, self).__init__(shm)
+
+    @staticmethod
+    def from_network(network, name=None):
+        publisher = WeightPublisher(network.layer_sizes, {'encoder': network.encoder.name}, name=name)
+        publisher.publish_network(network)
+        return publisher
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, params):
+        """
+        Copy a flat parameter buffer into the free slot and make it the
+        current version.
+        """
+        slot = (int(self.header[1]) + 1) % SLOTS if self.version else 0
+        sequence = 2 + slot
+        self.header[sequence] += 1
+        self.slots[slot][:] = params
+        self.header[sequence] += 1
+        self.header[1] = slot
+        self.header[0] += 1
+        return self.version
+
+    def publish_network(self, network):
+        network = network.dequantize() if network.precision != 'float32' else network
+        return self.publish(np.concatenate([np.ravel(a) for _, a in network.arrays()]))
+
+    def unlink(self):
+        # subscribers sharing the resource tracker of this process dropped
+        # the registration of the block, unlink expects it
+        resource_tracker.register(self.shm._name, 'shared_memory')
+        self.shm.unlink()
+
+
+class WeightSubscriber(_Block):
+    def __init__(self, name):
+        """
+        Attach to the block of a WeightPublisher. Behaves like a Network
+        that follows the latest published version.
+        """
+        shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        # the publisher owns the block, the resource tracker must not
+        # remove it when this process exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        super(WeightSubscriber, self).__init__(shm)
+        self.current = None
+        self.network = None
+        self.poll()
+
+    @property
+    def encoder(self):
+        return self.network.encoder
+
+    def poll(self):
+        """
+        Switch to the latest version, returns True if it changed.
+        """
+        version = self.version
+        if version == self.current:
+            return False
+        if version == 0:
+            raise ValueError('Nothing published yet on %s' % self.shm.name)
+        slot = int(self.header[1])
+        weights, biases = _views(self.slots[slot], self.layer_sizes)
+        self.slot = slot
+        self.network = Network(weights, biases, self.metadata)
+        self.current = version
+        return True
+
+    def get_output(self, x):
+        while True:
+            self.poll()
+            sequence = self.header[2 + self.slot]
+            output = self.network.get_output(x)
+            # the slot was written during the evaluation, read it again
+            if sequence % 2 == 0 and self.header[2 + self.slot] == sequence:
+                return output
+
+    def close(self):
+        self.network = None
+        super(WeightSubscriber, self).close()
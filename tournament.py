@@ -0,0 +1,166 @@
+"""
+Tournaments between exported network snapshots.
+
+Every pairing is played as mirrored game pairs: both games use the same
+dice seed, with the colors swapped in the second one, which cancels most
+of the luck of the dice. Matches run in a pool of worker processes and the
+results are accumulated in a json file, from which maximum likelihood
+(BayesElo style) ratings are fitted.
+"""
+from __future__ import division
+
+import os
+import json
+import glob
+import math
+import random
+import itertools
+import multiprocessing
+
+from backgammon.game import Game
+from backgammon.agents.td_gammon_agent import TDAgent
+from network import Network
+
+# networks already loaded by this worker process
+_networks = {}
+
+
+def load_pool(directory):
+    """
+    Snapshot files of a directory, oldest first.
+    """
+    return sorted(glob.glob(os.path.join(directory, '*.tdg')), key=os.path.getmtime)
+
+
+def schedule(pool, mode='round-robin', challenger=None):
+    """
+    Pairings to play: every pair of the pool, or the challenger against
+    every member of the pool for a gauntlet.
+    """
+    if mode == 'round-robin':
+        return list(itertools.combinations(pool, 2))
+    if mode == 'gauntlet':
+        if challenger is None:
+            raise ValueError('A gauntlet needs a challenger')
+        return [(challenger, opponent) for opponent in pool if opponent != challenger]
+    raise ValueError('Unknown tournament mode %s' % mode)
+
+
+def _network(path):
+    if path not in _networks:
+        _networks[path] = Network.load(path)
+    return _networks[path]
+
+
+def play_pair(path_a, path_b, seed):
+    """
+    Play one mirrored pair of games, returns the points scored by a.
+    """
+    score = 0
+    for colors in [(path_a, path_b), (path_b, path_a)]:
+        players = [TDAgent(Game.TOKENS[i], _network(path)) for i, path in enumerate(colors)]
+        game = Game.new(rng=random.Random(seed))
+        winner = game.play(players)
+        if colors[winner] == path_a:
+            score += 1
+    return score
+
+
+def play_match(task):
+    path_a, path_b, seeds = task
+    return [(path_a, path_b, play_pair(path_a, path_b, seed)) for seed in seeds]
+
+
+def fit_ratings(results, prior=1., iterations=100):
+    """
+    Fit Elo ratings to (player_a, player_b, wins_a, games) results with
+    the minorization-maximization algorithm for the Bradley-Terry model.
+    prior adds that many virtual drawn games to every pairing so that
+    unbeaten players keep a finite rating. Ratings are centered on 1500.
+    """
+    wins = {}
+    games = {}
+    for a, b, won, played in results:
+        key = tuple(sorted((a, b)))
+        if key not in games:
+            # the virtual draws of a new pairing, half a win each
+            games[key] = prior
+            for p in key:
+                wins[p] = wins.get(p, 0.) + prior / 2.
+        wins[a] += won
+        wins[b] += played - won
+        games[key] += played
+
+    players = sorted(wins)
+    gamma = dict((p, 1.) for p in players)
+    for _ in range(iterations):
+        for p in players:
+            denominator = 0.
+            for (a, b), played in games.items():
+                if p in (a, b):
+                    other = b if p == a else a
+                    denominator += played / (gamma[p] + gamma[other])
+            gamma[p] = wins[p] / denominator if denominator else gamma[p]
+        # normalize to keep the geometric mean at 1
+        mean = math.exp(sum(math.log(g) for g in gamma.values()) / len(gamma))
+        for p in players:
+            gamma[p] /= mean
+
+    return dict((p, 1500. + 400. * math.log10(gamma[p])) for p in players)
+
+
+class Tournament(object):
+    def __init__(self, results_path):
+        """
+        Tournament results persisted in results_path, as a list of
+        [player_a, player_b, wins_a, games] entries.
+        """
+        self.results_path = results_path
+        self.results = []
+        if os.path.exists(results_path):
+            with open(results_path) as f:
+                self.results = json.load(f)['results']
+
+    def run(self, pairings, pairs=50, workers=None, seed=0):
+        """
+        Play pairs mirrored game pairs for every pairing, across workers
+        processes.
+        """
+        rng = random.Random(seed)
+        tasks = []
+        for path_a, path_b in pairings:
+            seeds = [rng.getrandbits(32) for _ in range(pairs)]
+            # split matches in chunks so that all workers stay busy
+            for i in range(0, pairs, 10):
+                tasks.append((path_a, path_b, seeds[i:i + 10]))
+
+        scores = {}
+        pool = multiprocessing.Pool(workers)
+        try:
+            for games in pool.imap_unordered(play_match, tasks):
+                for path_a, path_b, score in games:
+                    won, played = scores.get((path_a, path_b), (0, 0))
+                    scores[(path_a, path_b)] = (won + score, played + 2)
+        finally:
+            pool.close()
+            pool.join()
+
+        for (path_a, path_b), (won, played) in sorted(scores.items()):
+            name_a, name_b = os.path.basename(path_a), os.path.basename(path_b)
+            self.results.append([name_a, name_b, won, played])
+            print("%s vs %s: %d/%d (%.2f%%)" % (name_a, name_b, won, played, won / played * 100.0))
+        self.save()
+        return self.ratings()
+
+    def ratings(self):
+        return fit_ratings(self.results)
+
+    def save(self):
+        tmp_path = self.results_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'results': self.results, 'ratings': self.ratings()}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.results_path)
+
+    def print_ratings(self):
+        for name, rating in sorted(self.ratings().items(), key=lambda item: -item[1]):
+            print("%7.1f  %s" % (rating, name))
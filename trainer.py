@@ -0,0 +1,110 @@
+"""
+Self-play training loop on the NumPy backend, the counterpart of
+Model.train that needs no TensorFlow session.
+"""
+from __future__ import division
+
+import os
+import time
+import random
+
+import numpy as np
+
+import evaluation
+import run_state
+from metrics import GameMetrics, BackgroundWriter, JsonLinesWriter
+from backgammon.game import Game
+from backgammon.agents.td_gammon_agent import TDAgent
+from backgammon.features import outcome_targets
+
+
+def train(optimizer, model_path, summary_path, run_state_path=None, resume=False, seed=None,
+          episodes=150000, validation_interval=100, snapshot_interval=1000, metrics_window=100,
+          state_interval=100, publisher=None, publish_interval=10):
+    snapshot_path = os.path.join(model_path, 'snapshots')
+    for path in [model_path, summary_path, snapshot_path]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    metrics = GameMetrics(window=metrics_window)
+    writer = BackgroundWriter()
+    summary_writer = JsonLinesWriter(os.path.join(summary_path, '%d.jsonl' % int(time.time())))
+
+    # dice and starting players come from their own generator, saved
+    # with the run state
+    rng = random.Random(seed)
+    start_episode = 0
+    path = run_state.latest(run_state_path) if resume and run_state_path else None
+    if path:
+        print('Resuming run state: %s' % path)
+        params, traces, meta = run_state.load(path)
+        optimizer.params[:] = params
+        # traces of single output run states were saved flat
+        optimizer.traces[:] = np.reshape(traces, optimizer.traces.shape)
+        optimizer.global_step = meta['global_step']
+        start_episode = meta['episode']
+        run_state.set_rng_state(rng, meta['dice_random'])
+        metrics.load_state(meta['metrics'])
+
+    network = optimizer.network
+    encoder = network.encoder
+    players = [TDAgent(Game.TOKENS[0], network),
+               TDAgent(Game.TOKENS[1], network)]
+
+    train_start_ts = time.time()
+    for episode in range(start_episode, episodes):
+        if episode != 0 and episode % validation_interval == 0:
+            evaluation.test(network, episodes=100)
+
+        start_ts = time.time()
+        game = Game.new(rng=rng)
+        optimizer.reset_traces()
+
+        player_num = rng.randint(0, 1)
+
+        x = encoder.encode(game, players[player_num].player)
+
+        game_step = 0
+        while not game.is_over():
+            game.next_step(players[player_num], player_num)
+            player_num = (player_num + 1) % 2
+
+            x_next = encoder.encode(game, players[player_num].player)
+            V_next = network.get_output(x_next)
+
+            V, delta = optimizer.update(x, V_next)
+            metrics.add_step(delta, float(np.mean(np.square(V_next - V))))
+
+            x = x_next
+            game_step += 1
+
+        winner = game.winner()
+        V_next = outcome_targets(game, network.layer_sizes[-1])
+        V, delta = optimizer.update(x, V_next)
+        metrics.add_step(delta, float(np.mean(np.square(V_next - V))))
+        metrics.add_game(game_step, winner)
+        if metrics.ready():
+            writer.submit(summary_writer.write_scalars, optimizer.global_step, metrics.flush())
+
+        end_ts = time.time()
+        print("Game %d/%d (Winner: %s) in %d turns (%.2f secs)" % (episode, episodes, players[winner].player, game_step, end_ts-start_ts))
+        if episode in [9, 99, 999, 9999, 99999]:
+            print("%d games avg time: %.2f secs" % (episode+1, (end_ts - train_start_ts) / (episode+1)))
+
+        network.metadata['global_step'] = optimizer.global_step
+        if publisher is not None and (episode + 1) % publish_interval == 0:
+            publisher.publish(optimizer.params)
+        if (episode + 1) % validation_interval == 0:
+            network.save(os.path.join(model_path, 'td_gammon.tdg'))
+        if (episode + 1) % snapshot_interval == 0:
+            network.save(os.path.join(snapshot_path, 'td_gammon-%d.tdg' % optimizer.global_step))
+        if run_state_path and (episode + 1) % state_interval == 0:
+            run_state.save(run_state_path, optimizer.params, optimizer.traces, {
+                'global_step': optimizer.global_step,
+                'episode': episode + 1,
+                'dice_random': run_state.rng_state(rng),
+                'metrics': metrics.state()})
+
+    writer.close()
+    network.save(os.path.join(model_path, 'td_gammon.tdg'))
+    evaluation.test(network, episodes=1000)